@@ -1,20 +1,77 @@
 import graphviz
+import hashlib
 import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 from yaml import dump
 import click
 from pprint import pprint
 import re
 import inflection
+from collections import defaultdict
+
+OUTPUT_DIR = "../gdcdictionary/schemas"
+# components exported by generate-all, with their neighbors
+DEFAULT_IDS = ("bts:Patient", "bts:Biospecimen", "bts:Assay", "bts:File")
+# parsed schema snapshots, next to the json-ld
+CACHE_DIR = ".cache"
+# bump when the indexes change, invalidates snapshots
+CACHE_VERSION = 1
+
+
+def _ids(value):
+    """@ids of a json-ld reference or list of references."""
+    if not isinstance(value, list):
+        value = [value]
+    return [v['@id'] for v in value]
+
 
 class HTANSchema(object):
 
-    def __init__(self, path="HTAN.jsonld") -> None:
-        """Load schema."""
-        self._json_schema = json.load(open(path, 'r'))
-        self._nodes = {n['@id']:n for n in self._json_schema['@graph']}
+    def __init__(self, path="HTAN.jsonld", cache=True) -> None:
+        """Load schema, from the snapshot keyed by the file's hash when cached."""
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        if not cache:
+            self._index(json.loads(content))
+            return
+        digest = hashlib.sha256(content).hexdigest()
+        cache_dir = os.path.join(os.path.dirname(path), CACHE_DIR)
+        name = os.path.splitext(os.path.basename(path))[0]
+        cache_path = os.path.join(cache_dir, f"{name}-{digest[:16]}-v{CACHE_VERSION}.pickle")
+        if os.path.isfile(cache_path):
+            with open(cache_path, 'rb') as fp:
+                self.__dict__.update(pickle.load(fp))
+            return
+        self._index(json.loads(content))
+        os.makedirs(cache_dir, exist_ok=True)
+        # snapshots of previous versions of the schema are stale
+        for stale in os.listdir(cache_dir):
+            if stale.startswith(f"{name}-") and stale.endswith(".pickle"):
+                os.remove(os.path.join(cache_dir, stale))
+        # write then rename, generate-all workers load concurrently
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump(self.__dict__, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    def _index(self, json_schema):
+        """Index nodes and the reverse relations once."""
+        self._nodes = {n['@id']:n for n in json_schema['@graph']}
         self._rangeMembers = []
         self._dependencies = []
+        # domain -> properties, superclass -> subclasses, component -> nodes requiring it
+        self._includes = defaultdict(list)
+        self._superClassOf = defaultdict(list)
+        self._dependents = defaultdict(list)
         for n in self._nodes.values():
+            for d in _ids(n.get("schema:domainIncludes", [])):
+                self._includes[d].append(n['@id'])
+            for s in _ids(n.get("rdfs:subClassOf", [])):
+                self._superClassOf[s].append(n['@id'])
+            for c in _ids(n.get("sms:requiresComponent", [])):
+                self._dependents[c].append(n['@id'])
             if "schema:rangeIncludes" in n:
                 rangeIncludes = n["schema:rangeIncludes"]
                 if not isinstance(rangeIncludes, list):
@@ -44,42 +101,19 @@ class HTANSchema(object):
         return None
 
     def _subclasses(self, id):
-        """Properties for a node."""
-        _ids = []
-        for n in self._nodes.values():
-            if "rdfs:subClassOf" in n and "sms:requiresComponent" in n:
-                if id in [i['@id'] for i in n.get("rdfs:subClassOf",[])]:
-                    if id in [i['@id'] for i in n.get("sms:requiresComponent",[])]:
-                        _ids.append(n['@id'])
-        return set(_ids)    
+        """Subclasses of a node that also require it as a component."""
+        return set(self._superClassOf.get(id, [])) & set(self._dependents.get(id, []))
 
     def properties(self, node=None, id=None):
         """Properties for a node."""
         if id in self._nodes:
             node = self._nodes[id]
         id = node['@id']
-        dependencies = set([d['@id'] for d in node.get("sms:requiresDependency",[])])    
-        includes = []
-        superClassOf = []
-        for n in self._nodes.values():
-            if "schema:domainIncludes" in n:
-                include = n["schema:domainIncludes"]
-                if not isinstance(include, list):
-                    include = [include]
-                for i in include:    
-                    if id == i['@id']:
-                        includes.append(n['@id'])
-            if "rdfs:subClassOf" in n:
-                subclass = n["rdfs:subClassOf"]
-                if not isinstance(subclass, list):
-                    subclass = [subclass]
-                for s in subclass:    
-                    if id == s['@id']:
-                        superClassOf.append(n['@id'])
-
-        includes = set(includes)
-        components = set([d['@id'] for d in node.get("sms:requiresComponent",[])])
-        subclassOf = set([d['@id'] for d in node.get("rdfs:subClassOf",[])])
+        dependencies = set(_ids(node.get("sms:requiresDependency", [])))
+        includes = set(self._includes.get(id, []))
+        superClassOf = self._superClassOf.get(id, [])
+        components = set(_ids(node.get("sms:requiresComponent", [])))
+        subclassOf = set(_ids(node.get("rdfs:subClassOf", [])))
         neighbors = set([d for d in components if len(self._nodes[d].get("sms:requiresDependency", [])) > 0 ])
         subclasses = self._subclasses(id)
         subclasses = set(list(subclasses) + superClassOf) - self._rangeMembers - self._dependencies
@@ -291,7 +325,8 @@ class Gen3Configuration(object):
         return 'clinical'
 
 
-    def save(self):
+    def render(self):
+        """Render the gen3 yaml, returns (id, yaml string)."""
         node = self.node
         template = self.template
         schema_node = self.schema.node(node['@id'])
@@ -378,22 +413,77 @@ class Gen3Configuration(object):
         #         }
         #     )
 
-        # save this node
         yaml_string = dump(template, sort_keys=False)
         yaml_string = re.sub(r'comment_.* ', '# ', yaml_string)
-        with open(f"../gdcdictionary/schemas/{template['id']}.yaml", "w") as output:
+        return template['id'], yaml_string
+
+    def save(self, output_dir=OUTPUT_DIR):
+        # save this node
+        id, yaml_string = self.render()
+        with open(f"{output_dir}/{id}.yaml", "w") as output:
             output.write(yaml_string)
-        print(f"wrote ../gdcdictionary/schemas/{template['id']}.yaml")
+        print(f"wrote {output_dir}/{id}.yaml")
+
+
+def components(schema, ids):
+    """{@id: parent @id} of the ids and their neighbors, as view would export them one id after the other.
+
+    A neighbor shared by several ids is rendered once, the last export wins as it would overwrite the others.
+    """
+    _components = {}
+    for id in ids:
+        assert schema.node(id), f'{id} not found in the schema'
+        node = schema.properties(id=id)
+        _components.pop(id, None)
+        _components[id] = None
+        for neighbor in node['neighbors']:
+            _components.pop(neighbor, None)
+            _components[neighbor] = id
+    return _components
 
-@click.command()
-@click.option('--id', help='Entity ID, e.g "bts:BulkRNA-seqLevel1"')
-@click.option('--path', default="HTAN.jsonld", help='e.g. wget https://raw.githubusercontent.com/ncihtan/schematic/main/data/schema_org_schemas/HTAN.jsonld')
-@click.option('--figure/--no-figure', default=False, help='Generate PDF Figure')
 
-def view(id, path, figure):
+_schema = None
+
+
+def _init_worker(path, cache):
+    global _schema
+    _schema = HTANSchema(path=path, cache=cache)
+
+
+def _render(component):
+    """Render one component in a worker."""
+    id, parent = component
+    node = _schema.properties(id=id)
+    return Gen3Configuration(_schema, node, parent=_schema.properties(id=parent) if parent else None).render()
+
+
+def view_options(command):
+    """Options of view, shared with the group so `generate_model.py --id ...` keeps working."""
+    for option in reversed([
+        click.option('--id', help='Entity ID, e.g "bts:BulkRNA-seqLevel1"'),
+        click.option('--path', default="HTAN.jsonld", help='e.g. wget https://raw.githubusercontent.com/ncihtan/schematic/main/data/schema_org_schemas/HTAN.jsonld'),
+        click.option('--figure/--no-figure', default=False, help='Generate PDF Figure'),
+        click.option('--cache/--no-cache', default=True, help=f'Reuse the parsed schema snapshot in {CACHE_DIR}'),
+    ]):
+        command = option(command)
+    return command
+
+
+@click.group(invoke_without_command=True)
+@view_options
+@click.pass_context
+def cli(ctx, id, path, figure, cache):
+    """Generate the gen3 dictionary from the HTAN schema, without a command runs view."""
+    if ctx.invoked_subcommand is None:
+        ctx.invoke(view, id=id, path=path, figure=figure, cache=cache)
+
+
+@cli.command()
+@view_options
+def view(id, path, figure, cache):
     assert id, 'Please specify an @id found in the schema, e.g "--id bts:BulkRNA-seqLevel1"'
     # Read the schema
-    schema = HTANSchema(path=path)
+    schema = HTANSchema(path=path, cache=cache)
     # Find the desired node
     node = schema.properties(id=id)
     # raise Exception(f"{node}")
@@ -413,8 +503,35 @@ def view(id, path, figure):
         neighbor_config.save()
 
 
+@cli.command('generate-all')
+@click.option('--id', 'ids', multiple=True, default=DEFAULT_IDS, show_default=True,
+              help='Entity IDs to export with their neighbors, repeatable')
+@click.option('--path', default="HTAN.jsonld", help='HTAN schema, see view')
+@click.option('--output_dir', default=OUTPUT_DIR, show_default=True, help='write yaml files here')
+@click.option('--workers', default=os.cpu_count(), help='render in this many processes')
+@click.option('--cache/--no-cache', default=True, help=f'Reuse the parsed schema snapshot in {CACHE_DIR}')
+def generate_all(ids, path, output_dir, workers, cache):
+    """Export all components in one pass, only writing files whose content changed."""
+    schema = HTANSchema(path=path, cache=cache)
+    _components = components(schema, ids)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(path, cache)) as executor:
+        rendered = list(executor.map(_render, _components.items()))
+    unchanged = 0
+    for id, yaml_string in rendered:
+        file_path = f"{output_dir}/{id}.yaml"
+        if os.path.isfile(file_path):
+            with open(file_path, "r") as fp:
+                if fp.read() == yaml_string:
+                    unchanged += 1
+                    continue
+        with open(file_path, "w") as output:
+            output.write(yaml_string)
+        print(f"wrote {file_path}")
+    print(f"{len(rendered)} components, {unchanged} unchanged")
+
+
 if __name__ == '__main__':
-    view()
+    cli()
 
 
 
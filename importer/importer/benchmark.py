@@ -0,0 +1,109 @@
+"""Micro benchmarks for the importer hot paths, e.g. python -m importer.benchmark codec --path data/umccr/simulated/case.json"""
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import tempfile
+import sys
+import time
+
+import click
+
+from importer import ioutils
+
+
+def synthetic_records(count, seed=0):
+    """Submission like records with strings, ints, floats, nulls and nested links, some unicode and odd floats."""
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        records.append({
+            'type': 'sample',
+            'submitter_id': f'sample-{i}',
+            'cases': [{'submitter_id': f'case-{rng.randrange(count // 10 + 1)}'}],
+            'composition': rng.choice(['Blood', 'Tissue', 'Buccal Cell', None]),
+            'days_to_collection': rng.randrange(-10000, 10000),
+            'current_weight': round(rng.random() * 100, 2),
+            'is_ffpe': rng.random() > 0.5,
+            'description': 'tab\tand "quotes"',
+        })
+        if i % 100 == 0:
+            # rarer values the fast codec hands back to the stdlib
+            records[-1].update({'current_weight': rng.random() * 10 ** rng.randrange(-6, 18),
+                                'description': rng.choice(['naïve ünïcödé', '\x7f del'])})
+        elif i % 100 == 50:
+            # orjson writes these as null
+            records[-1]['current_weight'] = rng.choice([float('nan'), float('inf'), float('-inf')])
+    return records
+
+
+def timed(fn, records):
+    """Seconds to apply fn to every record, and the results."""
+    start = time.perf_counter()
+    results = [fn(record) for record in records]
+    return time.perf_counter() - start, results
+
+
+@click.group()
+def cli():
+    """Importer benchmarks."""
+
+
+@cli.command()
+@click.option('--path', default=None, help='records to encode, any file reader() supports; synthetic if omitted')
+@click.option('--count', default=100000, help='number of synthetic records')
+def codec(path, count):
+    """Compares the configured json codec with the stdlib, fails unless the output bytes are identical."""
+    records = list(ioutils.reader(path)) if path else synthetic_records(count)
+    lines = [json.dumps(record, separators=ioutils.COMPACT) for record in records]
+
+    stdlib_seconds, expected = timed(lambda record: json.dumps(record, separators=ioutils.COMPACT).encode(), records)
+    codec_seconds, actual = timed(ioutils.dumpb, records)
+    mismatches = sum(1 for a, b in zip(expected, actual) if a != b)
+    stdlib_loads, _ = timed(json.loads, lines)
+    codec_loads, decoded = timed(ioutils.loads, lines)
+    # compared as text, NaN != NaN
+    mismatches += sum(1 for line, record in zip(lines, decoded)
+                      if json.dumps(record, separators=ioutils.COMPACT) != line)
+
+    print(f"codec: {ioutils.JSON_CODEC}, records: {len(records):,}, bytes: {sum(map(len, expected)):,}")
+    print(f"dumps  json {stdlib_seconds:.3f}s  {ioutils.JSON_CODEC} {codec_seconds:.3f}s"
+          f"  x{stdlib_seconds / max(codec_seconds, 1e-9):.1f}")
+    print(f"loads  json {stdlib_loads:.3f}s  {ioutils.JSON_CODEC} {codec_loads:.3f}s"
+          f"  x{stdlib_loads / max(codec_loads, 1e-9):.1f}")
+    print(f"identical: {mismatches == 0} ({mismatches} mismatches)")
+    sys.exit(1 if mismatches else 0)
+
+
+@cli.command('gzip')
+@click.option('--count', default=200000, help='number of synthetic records')
+@click.option('--block_size', default=ioutils.DEFAULT_BLOCK_SIZE, help='uncompressed bytes per gzip member')
+@click.option('--threads', default=os.cpu_count(), help='compression threads')
+@click.option('--compresslevel', default=9)
+def gzip_(count, block_size, threads, compresslevel):
+    """Compares single stream with parallel multi-member JSONEmitter output, fails unless content is identical."""
+    records = synthetic_records(count)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir, contextlib.redirect_stderr(io.StringIO()):
+        for name, options in (('single', {}), ('parallel', {'block_size': block_size, 'threads': threads})):
+            path = os.path.join(tmp_dir, f"{name}.json.gz")
+            start = time.perf_counter()
+            with ioutils.JSONEmitter(path, compresslevel=compresslevel, **options) as emitter:
+                for record in records:
+                    emitter.write(record)
+            seconds = time.perf_counter() - start
+            with open(path, 'rb') as fp:
+                compressed = fp.read()
+            results[name] = (seconds, len(compressed), hashlib.sha256(gzip.decompress(compressed)).hexdigest())
+    for name, (seconds, size, _) in results.items():
+        print(f"{name:8} {seconds:.3f}s  {size:,} bytes")
+    identical = results['single'][2] == results['parallel'][2]
+    print(f"threads: {threads}, x{results['single'][0] / max(results['parallel'][0], 1e-9):.1f}, identical: {identical}")
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == '__main__':
+    cli()
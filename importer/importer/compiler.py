@@ -0,0 +1,306 @@
+"""Compiles a dictionary's yaml schemas into schema/<program>.json, natively instead of `g3po dd convert`.
+
+The output is byte identical to g3po: one key per yaml file in name order, json.dumps default
+separators, and the _dict_commit/_dict_version settings g3po adds to _settings.yaml. The json of
+every file is cached with its hash, so only changed files are parsed again and spliced into the output.
+"""
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+import click
+import yaml
+
+from importer.dictionary import ResolvedDictionary
+from importer import validator
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeLoader
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # pragma: no cover
+    INotify = None
+
+DEFAULT_DICTIONARY_DIR = 'dictionary'
+DEFAULT_SCHEMA_DIR = 'schema'
+# per file json and hashes, under the schema dir
+CACHE_DIR = '.cache'
+# bump when the cache layout changes
+CACHE_VERSION = 1
+SETTINGS = '_settings.yaml'
+VERSION_KEYS = ('_dict_commit', '_dict_version')
+# seconds between directory scans when inotify is not available
+DEFAULT_POLL_INTERVAL = 0.1
+# seconds to wait for the rest of an editor's save (temp file, rename) after the first event
+DEBOUNCE = 0.02
+
+
+def schemas_dir(dictionary_dir, program):
+    """Directory of a dictionary's yaml files."""
+    return os.path.join(dictionary_dir, program, 'gdcdictionary', 'schemas')
+
+
+def find_programs(dictionary_dir):
+    """Programs with a gdcdictionary/schemas directory."""
+    return sorted(name for name in os.listdir(dictionary_dir) if os.path.isdir(schemas_dir(dictionary_dir, name)))
+
+
+def load_yaml(content, name=None):
+    """Parse yaml with libyaml when available, errors point at name rather than "<byte string>"."""
+    if name:
+        content = io.BytesIO(content)
+        content.name = name
+    return yaml.load(content, Loader=SafeLoader)
+
+
+def git_versions(directory):
+    """_dict_commit and _dict_version from git, {} outside a repository."""
+    try:
+        commit = subprocess.check_output(['git', '-C', directory, 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL)
+        version = subprocess.check_output(['git', '-C', directory, 'describe', '--tags', '--long', '--always'],
+                                          stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    return {'_dict_commit': commit.decode().strip(), '_dict_version': version.decode().strip()}
+
+
+class Compiler:
+    """Incremental compiler of one dictionary."""
+
+    def __init__(self, program, dictionary_dir=DEFAULT_DICTIONARY_DIR, schema_dir=DEFAULT_SCHEMA_DIR, versions=None):
+        """versions overrides the _dict_commit/_dict_version settings, kept from the last output by default."""
+        self.program = program
+        self.source_dir = schemas_dir(dictionary_dir, program)
+        assert os.path.isdir(self.source_dir), f"{self.source_dir} not found"
+        self.output_path = os.path.join(schema_dir, f"{program}.json")
+        self.cache_path = os.path.join(schema_dir, CACHE_DIR, f"{program}.json")
+        self.cache = self._load_cache()
+        if versions:
+            self.cache['versions'] = dict(versions)
+        # the file the last compile failed to parse
+        self.broken = None
+
+    def _load_cache(self):
+        if os.path.isfile(self.cache_path):
+            with open(self.cache_path, 'r') as fp:
+                cache = json.load(fp)
+            if cache.get('version') == CACHE_VERSION:
+                return cache
+        return {'version': CACHE_VERSION, 'versions': None, 'files': {}}
+
+    def _save_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        _write(self.cache_path, json.dumps(self.cache))
+
+    def versions(self):
+        """_dict_commit/_dict_version: cached, from the current output (e.g. written by g3po) or from git."""
+        if self.cache['versions'] is None:
+            versions = {}
+            if os.path.isfile(self.output_path):
+                with open(self.output_path, 'r') as fp:
+                    settings = json.load(fp).get(SETTINGS, {})
+                versions = {key: settings[key] for key in VERSION_KEYS if key in settings}
+            self.cache['versions'] = versions or git_versions(self.source_dir)
+        return self.cache['versions']
+
+    def names(self):
+        """yaml files of the dictionary, in output order."""
+        return sorted(name for name in os.listdir(self.source_dir) if name.endswith('.yaml'))
+
+    def document(self, name):
+        """Compiled content of one yaml file."""
+        return json.loads(self.cache['files'][name]['json'])
+
+    def documents(self):
+        """Compiled content of the whole dictionary, as written to the output."""
+        with open(self.output_path, 'r') as fp:
+            return json.load(fp)
+
+    def compile(self, force=False):
+        """Parse changed files and rewrite the output, returns the names of changed, added or removed files."""
+        files = self.cache['files']
+        names = self.names()
+        changed = [name for name in files if name not in names]
+        # applied once every file parsed, a yaml error leaves cache and output as they were
+        updates = {}
+        self.broken = None
+        for name in names:
+            path = os.path.join(self.source_dir, name)
+            stat = os.stat(path)
+            entry = files.get(name)
+            if not force and entry and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                continue
+            with open(path, 'rb') as fp:
+                content = fp.read()
+            digest = hashlib.sha256(content).hexdigest()
+            if force or not entry or entry['sha256'] != digest:
+                try:
+                    document = load_yaml(content, path)
+                except yaml.YAMLError:
+                    self.broken = name
+                    raise
+                entry = {'sha256': digest, 'json': json.dumps(document)}
+                changed.append(name)
+            updates[name] = dict(entry, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        for name in changed:
+            files.pop(name, None)
+        files.update(updates)
+        if changed or not os.path.isfile(self.output_path):
+            self.versions()
+            _write(self.output_path, self.render())
+        self._save_cache()
+        return changed
+
+    def render(self):
+        """The output, splicing the cached json of every file."""
+        fragments = []
+        for name in sorted(self.cache['files']):
+            fragment = self.cache['files'][name]['json']
+            if name == SETTINGS and self.cache['versions']:
+                settings = json.loads(fragment)
+                settings.update(self.cache['versions'])
+                fragment = json.dumps(settings)
+            fragments.append(f"{json.dumps(name)}: {fragment}")
+        return '{' + ', '.join(fragments) + '}'
+
+
+def watch_changes(directory, interval=DEFAULT_POLL_INTERVAL):
+    """Yields once per burst of yaml file changes in directory, with inotify or by polling."""
+    if INotify:
+        inotify = INotify()
+        inotify.add_watch(directory, flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.CREATE | flags.DELETE)
+        while True:
+            events = inotify.read()
+            events += inotify.read(timeout=int(DEBOUNCE * 1000))
+            if any(event.name.endswith('.yaml') for event in events):
+                yield
+    stats = None
+    while True:
+        current = {entry.name: (entry.stat().st_mtime_ns, entry.stat().st_size)
+                   for entry in os.scandir(directory) if entry.name.endswith('.yaml')}
+        if stats is not None and current != stats:
+            yield
+        stats = current
+        time.sleep(interval)
+
+
+def check(dictionary, names):
+    """Checks names and their link neighbors, returns {name: errors} of the nodes checked."""
+    nodes = set(dictionary.nodes())
+    touched = set()
+    for name in names:
+        if name in nodes:
+            touched.add(name)
+        touched.update(dictionary.neighbors(name))
+    return {name: dictionary.check(name) for name in sorted(touched)}
+
+
+def report(results, file=sys.stderr):
+    """Logs check results, returns the number of nodes with errors."""
+    failed = 0
+    for name, errors in results.items():
+        failed += bool(errors)
+        for error in errors:
+            print(f"ERROR {name}: {error}", file=file)
+    return failed
+
+
+def _write(path, content):
+    """Replace path atomically, ddvis may be serving it."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as fp:
+        fp.write(content)
+    os.replace(tmp_path, path)
+
+
+@click.group()
+def cli():
+    """Dictionary tools."""
+
+
+@cli.command('compile')
+@click.option('--program', 'programs', multiple=True, help='dictionary to compile, repeatable, default all')
+@click.option('--dictionary_dir', default=DEFAULT_DICTIONARY_DIR, help='read dictionary/<program>/gdcdictionary/schemas')
+@click.option('--schema_dir', default=DEFAULT_SCHEMA_DIR, help='write <schema_dir>/<program>.json')
+@click.option('--force', is_flag=True, help='parse every file, ignoring the cache')
+@click.option('--dict_commit', default=None, help='_dict_commit setting, default kept from the last output or git')
+@click.option('--dict_version', default=None, help='_dict_version setting, default kept from the last output or git')
+def compile_command(programs, dictionary_dir, schema_dir, force, dict_commit, dict_version):
+    """Compiles yaml schemas into <schema_dir>/<program>.json, only parsing files changed since the last build."""
+    versions = {key: value for key, value in zip(VERSION_KEYS, (dict_commit, dict_version)) if value}
+    for program in programs or find_programs(dictionary_dir):
+        compiler = Compiler(program, dictionary_dir, schema_dir, versions)
+        changed = compiler.compile(force=force)
+        print(f"INFO {compiler.output_path}: {len(changed)} of {len(compiler.names())} files compiled")
+
+
+@cli.command()
+@click.option('--program', required=True, help='dictionary to watch')
+@click.option('--dictionary_dir', default=DEFAULT_DICTIONARY_DIR, help='read dictionary/<program>/gdcdictionary/schemas')
+@click.option('--schema_dir', default=DEFAULT_SCHEMA_DIR, help='write <schema_dir>/<program>.json')
+@click.option('--interval', default=DEFAULT_POLL_INTERVAL, help='seconds between scans without inotify')
+def watch(program, dictionary_dir, schema_dir, interval):
+    """Recompiles <schema_dir>/<program>.json on every save, checking the changed nodes and their neighbors."""
+    compiler = Compiler(program, dictionary_dir, schema_dir)
+    compiler.compile()
+    dictionary = ResolvedDictionary(compiler.documents())
+    failed = report({name: dictionary.check(name) for name in dictionary.nodes()})
+    print(f"INFO watching {compiler.source_dir} ({'inotify' if INotify else 'polling'}),"
+          f" {len(dictionary.nodes())} nodes, {failed} with errors", file=sys.stderr)
+    for _ in watch_changes(compiler.source_dir, interval):
+        start = time.perf_counter()
+        broken = compiler.broken
+        try:
+            changed = compiler.compile()
+        except yaml.YAMLError as e:
+            print(f"ERROR {e}", file=sys.stderr)
+            continue
+        if broken:
+            # reverted to the cached content, nothing else to report
+            print(f"INFO {broken} parses again", file=sys.stderr)
+        if not changed:
+            continue
+        names = set(compiler.names())
+        dictionary.update({name: compiler.document(name) for name in changed if name in names},
+                          removed=[name for name in changed if name not in names])
+        results = check(dictionary, changed)
+        failed = report(results)
+        print(f"INFO compiled {', '.join(changed)} in {1000 * (time.perf_counter() - start):.0f}ms,"
+              f" checked {len(results)} nodes, {failed} with errors", file=sys.stderr)
+
+
+@cli.command()
+@click.option('--program', 'programs', multiple=True, help='dictionary to validate, repeatable, default all')
+@click.option('--dictionary_dir', default=DEFAULT_DICTIONARY_DIR, help='read dictionary/<program>/gdcdictionary')
+@click.option('--schema_dir', default=DEFAULT_SCHEMA_DIR, help='compile <schema_dir>/<program>.json first')
+@click.option('--workers', default=None, type=int, help='validate examples in this many processes, default cpu count')
+def validate(programs, dictionary_dir, schema_dir, workers):
+    """Compiles, checks every node schema and validates examples/valid and examples/invalid."""
+    failed = 0
+    for program in programs or find_programs(dictionary_dir):
+        start = time.perf_counter()
+        compiler = Compiler(program, dictionary_dir, schema_dir)
+        compiler.compile()
+        documents = compiler.documents()
+        dictionary = ResolvedDictionary(documents)
+        errors = report({name: dictionary.check(name) for name in dictionary.nodes()})
+        failures, files = validator.validate_examples(documents, validator.examples_dir(dictionary_dir, program),
+                                                      workers)
+        for path, failure in failures:
+            print(f"ERROR {path}: {failure}", file=sys.stderr)
+        failed += errors + len(failures)
+        print(f"INFO {program}: {len(dictionary.nodes())} nodes, {errors} with errors;"
+              f" {files} examples, {len(failures)} failed ({validator.VALIDATOR},"
+              f" {time.perf_counter() - start:.2f}s)", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    cli()
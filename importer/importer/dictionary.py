@@ -0,0 +1,134 @@
+"""A compiled dictionary with every $ref resolved once, and structural checks of its node schemas.
+
+References are resolved the way dictionaryutils does: the referenced fragment, itself resolved against
+its own document, is merged into the object holding the $ref, siblings of the $ref win.
+"""
+try:
+    import jsonschema
+except ImportError:  # pragma: no cover
+    jsonschema = None
+
+# shared definitions, a change invalidates every resolved node
+SHARED = ('_definitions.yaml', '_terms.yaml')
+
+
+def _pointer(document, pointer):
+    """Fragment of document at a json pointer ('/a/b')."""
+    for token in pointer.split('/')[1:] if pointer else []:
+        token = token.replace('~1', '/').replace('~0', '~')
+        document = document[int(token)] if isinstance(document, list) else document[token]
+    return document
+
+
+def links_of(schema):
+    """Links of a node schema with subgroups expanded."""
+    for link in schema.get('links', []):
+        if 'subgroup' in link:
+            yield from links_of({'links': link['subgroup']})
+        else:
+            yield link
+
+
+class ResolvedDictionary:
+    """Documents keyed by file name (case.yaml), as in schema/<program>.json."""
+
+    def __init__(self, documents):
+        """Nothing is resolved until asked for."""
+        self.documents = dict(documents)
+        # (file name, pointer) -> resolved fragment; file name -> resolved schema
+        self._references = {}
+        self._schemas = {}
+
+    def update(self, documents, removed=()):
+        """Replace changed documents, forgetting what was resolved from them."""
+        names = set(documents) | set(removed)
+        self.documents.update(documents)
+        for name in removed:
+            self.documents.pop(name, None)
+        if names.intersection(SHARED):
+            self._references.clear()
+            self._schemas.clear()
+            return
+        # nodes may reference each other, e.g. read_group.yaml#/properties/platform
+        self._references = {key: value for key, value in self._references.items() if key[0] not in names}
+        self._schemas.clear()
+
+    def nodes(self):
+        """File names of the node schemas."""
+        return sorted(name for name, document in self.documents.items()
+                      if not name.startswith('_') and isinstance(document, dict) and 'id' in document)
+
+    def reference(self, value, root):
+        """Resolved fragment a $ref points to, root is the name of the document holding the $ref."""
+        base, _, pointer = value.partition('#')
+        base = base or root
+        key = (base, pointer)
+        if key not in self._references:
+            assert base in self.documents, f"{value}: {base} not found"
+            try:
+                fragment = _pointer(self.documents[base], pointer)
+            except (KeyError, IndexError, ValueError, TypeError):
+                raise AssertionError(f"{value}: {pointer} not found in {base}")
+            self._references[key] = self.resolve(fragment, base)
+        return self._references[key]
+
+    def resolve(self, obj, root):
+        """obj with every $ref replaced by its resolved fragment."""
+        if isinstance(obj, dict):
+            resolved = {}
+            for key, value in obj.items():
+                if key == '$ref':
+                    for ref in value if isinstance(value, list) else [value]:
+                        resolved.update(self.reference(ref, root))
+                else:
+                    resolved[key] = self.resolve(value, root)
+            return resolved
+        if isinstance(obj, list):
+            return [self.resolve(item, root) for item in obj]
+        return obj
+
+    def schema(self, name):
+        """Resolved schema of a node, e.g. schema('case.yaml')."""
+        if name not in self._schemas:
+            self._schemas[name] = self.resolve(self.documents[name], name)
+        return self._schemas[name]
+
+    def neighbors(self, name):
+        """Nodes name links to and nodes linking to name."""
+        ids = {self.documents[node]['id']: node for node in self.nodes()}
+        _id = self.documents.get(name, {}).get('id', name[:-len('.yaml')])
+        neighbors = set()
+        for node in ids.values():
+            targets = {link.get('target_type') for link in links_of(self.documents[node])}
+            if node == name:
+                neighbors.update(ids[target] for target in targets if target in ids)
+            elif _id in targets:
+                neighbors.add(node)
+        neighbors.discard(name)
+        return neighbors
+
+    def check(self, name):
+        """Problems of one node schema, [] when it is sound."""
+        document = self.documents[name]
+        errors = []
+        if document.get('id') != name[:-len('.yaml')]:
+            errors.append(f"id {document.get('id')} does not match the file name")
+        try:
+            schema = self.schema(name)
+        except AssertionError as e:
+            return errors + [f"unresolved $ref {e}"]
+        ids = {self.documents[node]['id'] for node in self.nodes()}
+        for link in links_of(document):
+            if link.get('target_type') not in ids:
+                errors.append(f"link {link.get('name')}: target_type {link.get('target_type')} not found")
+            elif link.get('name') not in document.get('properties', {}):
+                errors.append(f"link {link.get('name')}: no property {link.get('name')}")
+        for required in document.get('required', []):
+            if required not in schema.get('properties', {}):
+                errors.append(f"required {required} is not a property")
+        if jsonschema:
+            try:
+                jsonschema.Draft4Validator.check_schema(schema)
+            except jsonschema.SchemaError as e:
+                errors.append(f"invalid schema: {e.message} at {'/'.join(map(str, e.path))}")
+        return errors
@@ -0,0 +1,104 @@
+"""Edge rows deduplicated per edge table, optionally sorted by (src_id, dst_id) with an external merge sort.
+
+A pair is kept as one 256 bit int, src_id.int << 128 | dst_id.int, in a set: about 100 bytes per pair. Ints
+order like the ids' text, so sorted keys give rows sorted by (src_id, dst_id). Sorted output buffers the pairs
+until the table is closed; past the memory budget they are sorted and spilled to a temporary file as 32 byte
+records, and the runs are merged when the table is closed, dropping pairs that landed in several runs.
+"""
+import heapq
+import tempfile
+
+# MiB of pairs buffered per edge table before a sorted run is spilled to disk
+DEFAULT_EDGE_MEMORY = 256
+# bytes of memory per pair: the int and its slot in the set
+PAIR_BYTES = 100
+# bytes per pair on disk
+KEY_BYTES = 32
+# bytes read per run and written per spill chunk
+RUN_BLOCK_SIZE = 1024 * 1024
+
+
+def pair_row(key):
+    """The tsv edge row of a pair key."""
+    h = f"{key:064x}"
+    return (f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}\t"
+            f"{h[32:40]}-{h[40:44]}-{h[44:48]}-{h[48:52]}-{h[52:]}\t{{}}\t{{}}\t{{}}\n")
+
+
+def write_run(keys, fp):
+    """Writes sorted keys as fixed size records."""
+    chunk = RUN_BLOCK_SIZE // KEY_BYTES
+    for i in range(0, len(keys), chunk):
+        fp.write(b''.join(key.to_bytes(KEY_BYTES, 'big') for key in keys[i:i + chunk]))
+
+
+def read_run(fp):
+    """Yields the keys of a run written by write_run."""
+    fp.seek(0)
+    while True:
+        block = fp.read(RUN_BLOCK_SIZE)
+        if not block:
+            return
+        for i in range(0, len(block), KEY_BYTES):
+            yield int.from_bytes(block[i:i + KEY_BYTES], 'big')
+
+
+class EdgeWriter:
+    """File like edge handle over a sink's handle, writes each (src_id, dst_id) once.
+
+    Without sort rows are written as they come and every pair is remembered, memory grows with the table.
+    With sort rows are written by close(), which the sinks call from copy().
+    """
+
+    def __init__(self, handle, sort=False, memory=DEFAULT_EDGE_MEMORY):
+        """memory in MiB, the budget of the buffered pairs of a sorted table."""
+        self.handle = handle
+        self.sort = sort
+        self.max_pairs = max(1, memory * 1024 * 1024 // PAIR_BYTES)
+        self.pairs = set()
+        self.runs = []
+        self.duplicates = 0
+
+    @property
+    def name(self):
+        """Name of the underlying file."""
+        return self.handle.name
+
+    def write_edge(self, src_id, dst_id):
+        """Write, or buffer, the row of an edge between two uuid.UUID unless it was seen before."""
+        key = src_id.int << 128 | dst_id.int
+        if key in self.pairs:
+            self.duplicates += 1
+            return
+        self.pairs.add(key)
+        if not self.sort:
+            self.handle.write(f'{src_id}\t{dst_id}\t{{}}\t{{}}\t{{}}\n')
+        elif len(self.pairs) >= self.max_pairs:
+            self._spill()
+
+    def _spill(self):
+        fp = tempfile.TemporaryFile()
+        write_run(sorted(self.pairs), fp)
+        self.runs.append(fp)
+        # a new set gives the memory back, clear() keeps the table
+        self.pairs = set()
+
+    def close(self):
+        """Write the sorted rows, then close the underlying handle."""
+        if self.sort:
+            previous = None
+            for key in heapq.merge(sorted(self.pairs), *[read_run(fp) for fp in self.runs]):
+                if key == previous:
+                    self.duplicates += 1
+                    continue
+                previous = key
+                self.handle.write(pair_row(key))
+            for fp in self.runs:
+                fp.close()
+            self.runs = []
+        self.pairs = set()
+        self.handle.close()
+
+    def rates(self):
+        """Rows and bytes written, see BufferedWriter.rates()."""
+        return self.handle.rates()
@@ -1,17 +1,34 @@
 """Utility, creates projects and nodes.  Deletes existing nodes of input type by default."""
+import functools
+import glob
+import hashlib
 import uuid
 import os
 import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import click
 
-from importer.ioutils import reader
-from importer.gen3 import generate_edge_tablename, get_class_tablename_from_id
+from importer.edges import DEFAULT_EDGE_MEMORY, EdgeWriter
+from importer.ioutils import DEFAULT_BUFFER_SIZE, BufferedWriter, dumpb, reader
+from importer.plan import import_levels, import_order, load_plan, plan_tables
+from importer.loader import SHARED_TABLES, Loader, copy_statement, shared_copy_statements
+from importer.metrics import DEFAULT_INTERVAL, Metrics
+from importer.profiling import DEFAULT_SAMPLE_INTERVAL, PROFILERS, profiled
+from importer.validator import RecordValidation
 
 
 PROJECT_ID = None
 PROGRAM_ID = None
 
+NODE_COLUMNS = 'node_id, acl, _sysan,  _props'
+EDGE_COLUMNS = 'src_id, dst_id, acl, _sysan, _props'
+# distinct submitter_ids remembered by get_uuid
+UUID_CACHE_SIZE = 2 ** 16
+NAMESPACE_BYTES = uuid.NAMESPACE_DNS.bytes
+
 
 def write_edge(link, line, project_id):
     """Writes edge file ready for sql import. Strips edge from submission node."""
@@ -23,23 +40,37 @@ def write_edge(link, line, project_id):
         edges = [edges]
     src_id = get_node_id(line)
 
-    for edge in edges:
-        if link['src_edge_property'] == 'projects':
-            dst_id = get_project_node_id(project_id)
-        if link['src_edge_property'] == 'programs':
-            dst_id = get_program_node_id(project_id)
-        else:
-            dst_id = get_uuid(edge.get('submitter_id', edge.get('code')))
-        link['handle'].write('{}\t{}\t{}\t{}\t{}\n'.format(
-            src_id, dst_id, '{}', '{}', '{}'))
+    if link['src_edge_property'] == 'programs':
+        dst_ids = [get_program_node_id(project_id)] * len(edges)
+    else:
+        dst_ids = get_uuids([edge.get('submitter_id', edge.get('code')) for edge in edges])
+    for dst_id in dst_ids:
+        link['handle'].write_edge(src_id, dst_id)
     del line[link['src_edge_property']]
     return line
 
 
+@functools.lru_cache(maxsize=UUID_CACHE_SIZE)
 def get_uuid(s):
+    """Deterministic id for a submitter_id or code, memoized as parents are referenced over and over."""
     return uuid.uuid5(uuid.NAMESPACE_DNS, s.lower())
 
 
+def get_uuids(values):
+    """Resolves a column of submitter_ids or codes in one call, each distinct value is hashed once."""
+    resolved = {}
+    for value in values:
+        if value not in resolved:
+            resolved[value] = get_uuid(value)
+    return [resolved[value] for value in values]
+
+
+@functools.lru_cache(maxsize=UUID_CACHE_SIZE)
+def id_key(s):
+    """The 128 bit sha1 digest get_uuid derives its id from, without building a UUID, to index ids compactly."""
+    return hashlib.sha1(NAMESPACE_BYTES + s.lower().encode()).digest()[:16]
+
+
 def get_node_id(line):
     """Returns uniq submitter_id."""
     if line['type'] == 'project':
@@ -66,42 +97,10 @@ def write_node(handle, line):
     for p in ['updated_datetime', 'created_datetime']:
         if p not in line:
             line[p] = now
-    handle.write('{}\t{}\t{}\t{}\n'.format(
-        node_id, '{}', '{}', json.dumps(line, separators=(',', ':'))))
+    handle.write(f'{node_id}\t{{}}\t{{}}\t', dumpb(line), b'\n')
     return line
 
 
-def get_tables(schema, line):
-    """Consolidates node and edge table names"""
-    assert 'type' in line, 'no "type" in record {}'.format(line)
-    type = line['type']
-    assert f"{type}.yaml" in schema.keys()
-    # print(schema[f"{type}.yaml"])
-    type_schema = schema[f"{type}.yaml"]
-    assert 'id' in type_schema, f'{type} not found in schema {type_schema}'
-    assert type == type_schema['id'], f'schema id should be the same as type {type}'
-    table_name = get_class_tablename_from_id(type)
-    tables = {'node_table': table_name, 'links': []}
-    for link in type_schema['links']:
-        if 'subgroup' not in link:
-            src_edge_property = link['name']
-            edge_table = generate_edge_tablename(type, link['label'], link['target_type'])
-            tables['links'].append(
-                {'src_edge_property': src_edge_property, 'edge_table': edge_table})
-        else:
-            for subgroup in link['subgroup']:
-                src_edge_property = subgroup['name']
-                edge_table = generate_edge_tablename(type, subgroup['label'], subgroup['target_type'])
-                tables['links'].append(
-                    {'src_edge_property': src_edge_property, 'edge_table': edge_table})
-    return tables
-
-
-def get_project_node_id(project_id):
-    """Returns the node_id"""
-    return PROJECT_ID
-
-
 def get_program_node_id(project_id):
     """Returns the node_id"""
     return PROGRAM_ID
@@ -114,66 +113,711 @@ DEFAULT_PROJECT = None
 DEFAULT_PATH = '**/*.json*'
 DEFAULT_BATCH_SIZE = 100
 DEFAULT_DELETE_FIRST = False
+DEFAULT_WORKERS = 1
+DEFAULT_LOADER = 'script'
+DEFAULT_INCREMENTAL = False
+# file: DataImportOrder.txt, derived: sort the project's <type>.json files by their links, auto: file if present
+IMPORT_ORDERS = ('auto', 'file', 'derived')
+DEFAULT_IMPORT_ORDER = 'auto'
+DEFAULT_CONCURRENT_LOAD = False
+DEFAULT_CHECK_REFERENCES = False
+DEFAULT_VALIDATE = False
+DEFAULT_SORT_EDGES = False
+# records failing validation, under output/<program>/<project>
+REJECTS = 'rejects.jsonl'
+# dangling submitter_ids listed per link
+MAX_DANGLING_EXAMPLES = 5
+
+# compiled import plans are cached here, under output_dir
+PLAN_DIR = '.plans'
+# input hashes of the last incremental import, under output_dir/program/project
+MANIFEST = '.manifest.json'
+# the script loader's manifest, renamed to MANIFEST by the last line of the script
+PENDING = '.pending'
 
 DEFAULT_CREDENTIALS_PATH = os.path.join('config', 'credentials.json')
 
 
+def resolve_ids(path, program, project):
+    """Pre-resolves the program and project node ids, so types can be transformed independently."""
+    global PROJECT_ID
+    global PROGRAM_ID
+    for line in reader(f"{path}/{program}/{project}/program.json"):
+        PROGRAM_ID = get_node_id(line)
+    for line in reader(f"{path}/{program}/{project}/project.json"):
+        PROJECT_ID = get_node_id(line)
+    return PROGRAM_ID, PROJECT_ID
+
+
+def init_worker(program_id, project_id):
+    """Seeds a worker process with the pre-resolved node ids."""
+    global PROJECT_ID
+    global PROGRAM_ID
+    PROGRAM_ID, PROJECT_ID = program_id, project_id
+
+
+class TsvSink:
+    """Writes rows to tsv files under output_dir and records the steps that load them."""
+
+    def __init__(self, output_dir, program, project, buffer_size=DEFAULT_BUFFER_SIZE, metrics=None):
+        """Set up steps."""
+        self.output_dir = output_dir
+        self.program = program
+        self.project = project
+        self.buffer_size = buffer_size
+        self.metrics = metrics or Metrics()
+        self.steps = []
+        # table -> BufferedWriter.rates()
+        self.stats = {}
+
+    def echo(self, message):
+        """Record a progress message."""
+        self.steps.append(('echo', message))
+
+    def sql(self, statement):
+        """Record a statement."""
+        self.steps.append(('sql', statement))
+
+    def scope(self, type, table, where):
+        """Record the type and the project's rows of the node table that follows."""
+        self.steps.append(('scope', type, table, where))
+
+    def open(self, table, columns):
+        """Open the tsv file for table."""
+        path = f"{self.output_dir}/{self.program}/{self.project}/{table}.tsv"
+        return BufferedWriter(open(path, 'wb'), buffer_size=self.buffer_size)
+
+    def copy(self, table, columns, handle):
+        """Close the tsv file and record its COPY."""
+        handle.close()
+        self.stats[table] = handle.rates()
+        self.steps.append(('copy', table, columns, handle.name))
+
+
+def render_levels(levels, steps):
+    """Renders the steps of every type level by level, the types of a level load as concurrent background jobs.
+
+    Every job is waited for by pid, so under set -e a failed job stops the script.
+    """
+    lines = []
+    for level in levels:
+        if len(level) == 1:
+            lines.append(render_script(steps[level[0]]))
+            continue
+        lines.append('pids=""')
+        for name in level:
+            lines.append(f"(\n{render_script(steps[name])}\n) &")
+            lines.append('pids="$pids $!"')
+        lines.append("for pid in $pids; do wait $pid; done")
+    return "\n".join(lines)
+
+
+def render_script(steps):
+    """Renders steps as the shell script piped into sh."""
+    lines = []
+    for step in steps:
+        if step[0] == 'echo':
+            lines.append(f"echo INFO {step[1]}")
+        elif step[0] == 'sql':
+            lines.append(f'$PSQL -c "{step[1]}"')
+        elif step[0] == 'copy':
+            _, table, columns, path = step
+            if table in SHARED_TABLES:
+                # the program node may already be there, loaded by another project
+                options = ' '.join(f'-c "{statement}"' for statement in shared_copy_statements(table, columns))
+                lines.append(f'cat  {path} | $PSQL {options}')
+            else:
+                lines.append(f'cat  {path} | $PSQL -c "{copy_statement(table, columns)}"')
+    return "\n".join(lines)
+
+
+def project_scope(type, program, project):
+    """Predicate selecting the project's rows of a node table, None for the shared program node."""
+    # the program node is shared by every project of the program, never deleted by one of them
+    if type == 'program':
+        return None
+    # the project node carries no project_id, it is keyed by its code
+    if type == 'project':
+        return f"_props->>'code' = '{project}'"
+    return f"_props->>'project_id' = '{program}-{project}'"
+
+
+def transform(name, path, program, project, plan, delete_first, sink, rejected=None, sort_edges=DEFAULT_SORT_EDGES,
+              edge_memory=DEFAULT_EDGE_MEMORY):
+    """Writes node and edge rows for one type to sink, skipping records whose submitter_id (code) is rejected.
+
+    Edges are written once per (src_id, dst_id), sorted by it with sort_edges, see importer.edges.
+    """
+    p = f"{path}/{program}/{project}/{name}.json"
+    tables = None
+    metrics = sink.metrics
+    transformed = metrics.counter('transform', name)
+    # a streaming sink COPYs full batches while rows are written, that time is load, not transform or write
+    loaded = metrics.counter('load', name)
+    clock = time.perf_counter
+    sink.echo(f"reading {p}")
+    for line in metrics.timed_iter('read', name, reader(p)):
+        start = clock()
+        load_start = loaded.seconds
+        if rejected and line.get('submitter_id', line.get('code')) in rejected:
+            continue
+        assert 'type' in line, f'must have type {line}'
+        if 'project_id' not in line and line['type'] != 'project':
+            line['project_id'] = f'{program}-{project}'
+        if line['type'] != 'project':
+            assert 'submitter_id' in line, f'must have submitter_id {line}'
+        if not tables:
+            tables = plan_tables(plan, line)
+            assert tables, f"echo No tables for {p} {line}?"
+            where = project_scope(line['type'], program, project)
+            sink.scope(name, tables['node_table'], where)
+            if delete_first and where:
+                sink.echo(f"deleting {program}-{project} from {tables['node_table']}")
+                sink.sql(f"delete from {tables['node_table']} where {where}  ;")
+            tables['handle'] = sink.open(tables['node_table'], NODE_COLUMNS)
+            for link in tables['links']:
+                link['handle'] = EdgeWriter(sink.open(link['edge_table'], EDGE_COLUMNS), sort_edges, edge_memory)
+
+        for link in tables['links']:
+            line = write_edge(link, line, f'{program}-{project}')
+        write_node(tables['handle'], line)
+        transformed.items += 1
+        transformed.seconds += clock() - start - (loaded.seconds - load_start)
+        metrics.maybe_snapshot()
+
+    if not tables and rejected:
+        sink.echo(f"every record of {p} rejected")
+        return
+    assert tables, f"echo No tables for {p}?"
+    with metrics.span('write', name) as written:
+        load_start = loaded.seconds
+        sink.echo(f"importing {tables['node_table']}")
+        sink.copy(tables['node_table'], NODE_COLUMNS, tables['handle'])
+        for link in tables['links']:
+            sink.echo(f"importing {link['edge_table']}")
+            sink.copy(link['edge_table'], EDGE_COLUMNS, link['handle'])
+            if link['handle'].duplicates:
+                sink.echo(f"dropped {link['handle'].duplicates} duplicate edges of {link['edge_table']}")
+        written.seconds -= loaded.seconds - load_start
+    for handle in [tables['handle']] + [link['handle'] for link in tables['links']]:
+        rates = handle.rates()
+        written.items += rates['rows']
+        written.bytes += rates['bytes']
+
+
+def transform_tsv(name, path, program, project, plan, delete_first, output_dir, rejects=None,
+                  sort_edges=DEFAULT_SORT_EDGES, edge_memory=DEFAULT_EDGE_MEMORY):
+    """Transforms one type to tsv files, returns the steps that load them and the metrics counters.
+
+    rejects maps types to the rejected submitter_ids transform skips.
+    """
+    sink = TsvSink(output_dir, program, project)
+    transform(name, path, program, project, plan, delete_first, sink, (rejects or {}).get(name), sort_edges,
+              edge_memory)
+    return sink.steps, sink.metrics.dump()
+
+
+def transform_parallel(imports, path, program, project, plan, delete_first, output_dir, workers, metrics,
+                       rejects=None, sort_edges=DEFAULT_SORT_EDGES, edge_memory=DEFAULT_EDGE_MEMORY):
+    """Transforms types to tsv files in a process pool, yields their steps in import order.
+
+    The workers' counters are merged into metrics.
+    """
+    # project and program edges are the only cross type dependency
+    ids = resolve_ids(path, program, project)
+    _transform = functools.partial(transform_tsv, path=path, program=program, project=project, plan=plan,
+                                   delete_first=delete_first, output_dir=output_dir, rejects=rejects,
+                                   sort_edges=sort_edges, edge_memory=edge_memory)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=ids) as executor:
+        # map yields in submission order, preserving the import order of the script
+        for steps, counters in executor.map(_transform, imports):
+            metrics.merge(counters)
+            yield steps
+
+
+def transaction_log(sink, program, project):
+    """Records the import in transaction_logs."""
+    sink.echo("importing transaction_logs")
+    sink.sql(f"INSERT INTO transaction_logs(submitter, role, program, project, is_dry_run, state, closed, created_datetime, canonical_json) VALUES ('admin', 'update', '{program}', '{project}', 'f', 'SUCCEEDED', 'f', current_timestamp, '{{}}');")
+
+
+def read_imports(path, program, project, plan, import_order=DEFAULT_IMPORT_ORDER):
+    """Types of a project in load order, from DataImportOrder.txt or derived from the schema's links."""
+    assert import_order in IMPORT_ORDERS, f"unknown import order {import_order}"
+    order_path = f"{path}/{program}/{project}/DataImportOrder.txt"
+    if import_order == 'file' or (import_order == 'auto' and os.path.isfile(order_path)):
+        return open(order_path, "r").read().splitlines()
+    return derive_imports(path, program, project, plan)
+
+
+def derive_imports(path, program, project, plan):
+    """Types with a <type>.json file in the project directory, each after the types it links to."""
+    names = [name[:-len('.json')] for name in os.listdir(f"{path}/{program}/{project}") if name.endswith('.json')]
+    return import_order(plan, [name for name in names if name in plan])
+
+
+def is_pipe(path):
+    """Whether path is a named pipe, or any other input that is not a regular file and can only be read once."""
+    return os.path.exists(path) and not os.path.isfile(path)
+
+
+def read_ahead(imports, check_refs=False, incremental=False, validate=False, workers=1):
+    """Types read before they are transformed, per option that is on."""
+    options = {
+        '--check_references': imports if check_refs else [],
+        '--incremental': imports if incremental else [],
+        '--validate': imports if validate else [],
+        # the program and project node ids are resolved up front for the worker processes
+        '--workers': ['program', 'project'] if workers > 1 else [],
+    }
+    return {option: names for option, names in options.items() if names}
+
+
+def check_single_pass(path, program, project, options):
+    """Stops with a clear error when an input is a pipe and an option reads it before its transform does."""
+    for option, names in options.items():
+        pipes = [f"{name}.json" for name in names if is_pipe(f"{path}/{program}/{project}/{name}.json")]
+        assert not pipes, (f"{option} reads {', '.join(pipes)} ahead of the import, a pipe can only be read once:"
+                           f" write it to a file or leave {option} off")
+
+
+def file_digest(path):
+    """sha256 of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(output_dir, program, project):
+    """Input hashes recorded by the last incremental import, {} if none."""
+    manifest_path = f"{output_dir}/{program}/{project}/{MANIFEST}"
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as fp:
+        return json.load(fp)
+
+
+def save_manifest(output_dir, program, project, manifest, pending=False):
+    """Records the input hashes of a completed import, or of a script yet to run with pending."""
+    with open(f"{output_dir}/{program}/{project}/{MANIFEST}{PENDING if pending else ''}", 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+
+
+def commit_manifest(output_dir, program, project):
+    """Script line promoting the pending manifest, reached only when every step before it succeeded (set -e)."""
+    manifest_path = f"{output_dir}/{program}/{project}/{MANIFEST}"
+    return f"mv {manifest_path}{PENDING} {manifest_path}"
+
+
+def select_imports(path, program, project, imports, plan, schema_digest, output_dir):
+    """Types whose input file, schema or upstream types changed since the last import.
+
+    Returns (changed types in import order, manifest of this import). A type is upstream when it is the
+    target of one of the type's links, reloading it cascades to the edges pointing at it.
+    """
+    previous = load_manifest(output_dir, program, project)
+    manifest = {
+        'schema': schema_digest,
+        'types': {name: file_digest(f"{path}/{program}/{project}/{name}.json") for name in imports},
+    }
+    schema_changed = previous.get('schema') != schema_digest
+    changed = []
+    for name in imports:
+        upstream = {link['target_type'] for link in plan.get(name, {}).get('links', [])}
+        if (schema_changed
+                or previous.get('types', {}).get(name) != manifest['types'][name]
+                or upstream.intersection(changed)):
+            changed.append(name)
+    return changed, manifest
+
+
+def check_references(path, program, project, plan, imports, metrics=None):
+    """Streams the submission once, checking every link points at a record of its target type.
+
+    Node ids are indexed per type in import order, a type's index is dropped once no type left to read
+    links to it; links to types read later (self links, a misordered DataImportOrder.txt) are checked
+    when their type is done, links to types not in the submission are not checked.
+    Returns {(type, link, target_type): [dangling references, example submitter_ids]}, records without
+    a type or submitter_id (code for project) as {(type, field, None): [records, example record numbers]}.
+    """
+    metrics = metrics or Metrics()
+    positions = {name: i for i, name in enumerate(imports)}
+    last_use = {}
+    for i, name in enumerate(imports):
+        for link in plan[name]['links']:
+            last_use[link['target_type']] = max(last_use.get(link['target_type'], -1), i)
+    indexes = {}
+    # target_type -> [(type, link, target_type, submitter_id, node id)] waiting for target_type to be read
+    pending = {}
+    dangling = {}
+
+    def check(key, reference, node_id, index):
+        if node_id not in index:
+            entry = dangling.setdefault(key, [0, []])
+            entry[0] += 1
+            if len(entry[1]) < MAX_DANGLING_EXAMPLES:
+                entry[1].append(reference)
+
+    for i, name in enumerate(imports):
+        index = indexes[name] = set()
+        links = [(link['src_edge_property'], link['target_type']) for link in plan[name]['links']
+                 if link['target_type'] in positions]
+        counter = metrics.counter('check', name)
+        start = time.perf_counter()
+        identifier = 'code' if name == 'project' else 'submitter_id'
+        for number, line in enumerate(reader(f"{path}/{program}/{project}/{name}.json"), 1):
+            counter.items += 1
+            if not isinstance(line, dict):
+                check((name, 'type', None), f"record {number}", None, ())
+                continue
+            for field in ('type', identifier):
+                if line.get(field) is None:
+                    check((name, field, None), f"record {number}", None, ())
+            if line.get(identifier) is not None:
+                index.add(id_key(line[identifier]))
+            for prop, target_type in links:
+                edges = line.get(prop)
+                if not edges:
+                    continue
+                key = (name, prop, target_type)
+                for edge in edges if isinstance(edges, list) else [edges]:
+                    if prop == 'programs':
+                        reference = program
+                    else:
+                        reference = edge.get('submitter_id', edge.get('code')) if isinstance(edge, dict) else None
+                    if reference is None:
+                        check(key, None, None, ())
+                        continue
+                    node_id = id_key(reference)
+                    if positions[target_type] < i:
+                        check(key, reference, node_id, indexes[target_type])
+                    else:
+                        pending.setdefault(target_type, []).append((key, reference, node_id))
+        for key, reference, node_id in pending.pop(name, []):
+            check(key, reference, node_id, index)
+        # nothing read from here on links to these
+        for target_type in [t for t in indexes if last_use.get(t, -1) <= i and t not in pending]:
+            del indexes[target_type]
+        counter.seconds += time.perf_counter() - start
+    return dangling
+
+
+def report_dangling(dangling, name, file=sys.stderr):
+    """Logs dangling references per link, records without type or submitter_id per type."""
+    for (type, prop, target_type), (count, examples) in sorted(dangling.items(), key=lambda item: str(item[0])):
+        if target_type is None:
+            print(f"ERROR {name} {type}: {count:,} records without {prop}, e.g. {', '.join(examples)}", file=file)
+            continue
+        print(f"ERROR {name} {type}.{prop} -> {target_type}: {count:,} dangling references,"
+              f" e.g. {', '.join(map(str, examples))}", file=file)
+
+
+def start_validation(path, program, project, imports, output_dir, workers=None, metrics=None):
+    """Validates the records of imports against schema/<program>.json in the background, see RecordValidation."""
+    with open(f"schema/{program}.json", 'rb') as fp:
+        documents = json.loads(fp.read())
+    validation = RecordValidation(documents, f"{path}/{program}/{project}", f"{program}-{project}",
+                                  f"{output_dir}/{program}/{project}/{REJECTS}", workers, metrics)
+    validation.submit(imports)
+    return validation
+
+
+def report_rejects(validation, name, file=sys.stderr):
+    """Logs the outcome of a validation."""
+    if validation.rejects:
+        print(f"ERROR {name}: {validation.rejects:,} of {validation.records:,} records failed validation, skipped,"
+              f" see {validation.rejects_path}", file=file)
+    else:
+        print(f"INFO {name}: {validation.records:,} records valid", file=file)
+
+
+def find_projects(patterns):
+    """Expands <path>/<program>/<project> directories or globs into (path, program, project)."""
+    jobs = []
+    for pattern in patterns:
+        for directory in sorted(glob.glob(pattern)):
+            if not any(os.path.isfile(os.path.join(directory, name)) for name in ('DataImportOrder.txt', 'project.json')):
+                continue
+            directory = os.path.normpath(directory)
+            program_dir, project = os.path.split(directory)
+            path, program = os.path.split(program_dir)
+            if (path, program, project) not in jobs:
+                jobs.append((path, program, project))
+    return jobs
+
+
+def import_project(job, plans, delete_first, output_dir, incremental=False, import_order=DEFAULT_IMPORT_ORDER,
+                   check_refs=DEFAULT_CHECK_REFERENCES, validate=DEFAULT_VALIDATE, sort_edges=DEFAULT_SORT_EDGES,
+                   edge_memory=DEFAULT_EDGE_MEMORY):
+    """Transforms one project of a batch to tsv files.
+
+    Returns (job, steps, manifest, metrics counters, error) rather than raising, so one bad project does
+    not stop the batch.
+    """
+    path, program, project = job
+    try:
+        os.makedirs(f"{output_dir}/{program}/{project}", exist_ok=True)
+        plan, schema_digest = plans[program]
+        imports = read_imports(path, program, project, plan, import_order)
+        check_single_pass(path, program, project, read_ahead(imports, check_refs, incremental, validate))
+        if check_refs:
+            dangling = check_references(path, program, project, plan, imports)
+            report_dangling(dangling, f"{program}-{project}")
+            assert not dangling, f"dangling references or unidentified records in {len(dangling)} links or types"
+        manifest = None
+        if incremental:
+            resolve_ids(path, program, project)
+            imports, manifest = select_imports(path, program, project, imports, plan, schema_digest, output_dir)
+        sink = TsvSink(output_dir, program, project)
+        # projects already run concurrently, each validates in its own process
+        validation = start_validation(path, program, project, imports, output_dir, 0, sink.metrics) \
+            if validate else None
+        for name in imports:
+            transform(name, path, program, project, plan, delete_first, sink,
+                      validation.rejected(name) if validation else None, sort_edges, edge_memory)
+        if validation:
+            report_rejects(validation, f"{program}-{project}")
+        transaction_log(sink, program, project)
+        return job, sink.steps, manifest, sink.metrics.dump(), None
+    except Exception as e:
+        return job, None, None, None, f"{type(e).__name__}: {e}"
+
+
+def import_batch(jobs, delete_first, output_dir, workers, copy_loader=None, incremental=False, metrics=None,
+                 import_order=DEFAULT_IMPORT_ORDER, check_refs=DEFAULT_CHECK_REFERENCES, validate=DEFAULT_VALIDATE,
+                 sort_edges=DEFAULT_SORT_EDGES, edge_memory=DEFAULT_EDGE_MEMORY):
+    """Imports many projects, sharing one plan per program, projects are transformed concurrently.
+
+    Prints one combined script, or loads each project in its own transaction with copy_loader.
+    Returns the failed jobs, counters of the projects are merged into metrics.
+    """
+    metrics = metrics or Metrics()
+    plans = {}
+    for _, program, _ in jobs:
+        if program not in plans:
+            plans[program] = load_plan(f"schema/{program}.json", os.path.join(output_dir, PLAN_DIR))
+    failed = []
+    _import_project = functools.partial(import_project, plans=plans, delete_first=delete_first,
+                                        output_dir=output_dir, incremental=incremental, import_order=import_order,
+                                        check_refs=check_refs, validate=validate, sort_edges=sort_edges,
+                                        edge_memory=edge_memory)
+    if incremental and not copy_loader:
+        # a manifest is only promoted when the script got that far
+        print("set -e")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for i, (job, steps, manifest, counters, error) in enumerate(executor.map(_import_project, jobs), 1):
+            name = f"{job[1]}-{job[2]}"
+            metrics.merge(counters)
+            if error is None and copy_loader:
+                try:
+                    with copy_loader.transaction() as sink:
+                        sink.replay(steps)
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+            elif error is None:
+                print(render_script(steps))
+            if error:
+                failed.append(job)
+                print(f"ERROR [{i}/{len(jobs)}] {name} failed, skipped: {error}", file=sys.stderr)
+            else:
+                if manifest and copy_loader:
+                    save_manifest(output_dir, job[1], job[2], manifest)
+                elif manifest:
+                    save_manifest(output_dir, job[1], job[2], manifest, pending=True)
+                    print(commit_manifest(output_dir, job[1], job[2]))
+                print(f"INFO [{i}/{len(jobs)}] {name} done", file=sys.stderr)
+            metrics.maybe_snapshot()
+    return failed
+
+
 @click.command()
 @click.option('--path', default=DEFAULT_INPUT_DIR, help='Read json from here')
 @click.option('--program', default=DEFAULT_PROGRAM, help='owning program')
 @click.option('--project', default=DEFAULT_PROJECT, help='owning project')
 @click.option('--delete_first', default=DEFAULT_DELETE_FIRST, help='delete all data first')
 @click.option('--output_dir', default=DEFAULT_OUTPUT_DIR, help='write files to this dir')
-def import_graph(path, program, project, delete_first, output_dir):
+@click.option('--workers', default=DEFAULT_WORKERS, help='transform node types in this many processes')
+@click.option('--loader', default=DEFAULT_LOADER, type=click.Choice(['script', 'copy', 'diff']),
+              help='script: print a psql script to pipe into sh, copy: COPY rows into postgres directly, '
+                   'diff: COPY into staging tables and only apply inserted, changed and vanished rows')
+@click.option('--dsn', default=None, help='postgres connection for --loader copy/diff, defaults to PG_* env')
+@click.option('--batch_size', default=DEFAULT_BATCH_SIZE, help='rows per COPY for --loader copy/diff')
+@click.option('--incremental', default=DEFAULT_INCREMENTAL,
+              help='only reload types whose input, schema or upstream types changed since the last import')
+@click.option('--import_order', default=DEFAULT_IMPORT_ORDER, type=click.Choice(IMPORT_ORDERS),
+              help='file: DataImportOrder.txt, derived: sort the <type>.json files by schema links, '
+                   'auto: the file when present')
+@click.option('--concurrent_load', default=DEFAULT_CONCURRENT_LOAD,
+              help='script loader: load the types of a dependency level as concurrent background jobs')
+@click.option('--check_references', 'check_refs', default=DEFAULT_CHECK_REFERENCES,
+              help='read the submission once before loading, stop on links to records that are not in it')
+@click.option('--validate', default=DEFAULT_VALIDATE,
+              help='validate records against the schema while transforming, skip invalid ones and write them to '
+                   f'output/<program>/<project>/{REJECTS}')
+@click.option('--validate_workers', default=None, type=int,
+              help='validate in this many processes, default cpu count')
+@click.option('--sort_edges', default=DEFAULT_SORT_EDGES,
+              help='write edge rows sorted by (src_id, dst_id), spilling sorted runs to disk past --edge_memory')
+@click.option('--edge_memory', default=DEFAULT_EDGE_MEMORY, help='MiB of edges buffered per edge table by --sort_edges')
+@click.option('--projects', multiple=True,
+              help='batch mode: <path>/<program>/<project> directories or globs, repeatable; '
+                   'replaces --path/--program/--project, --workers then counts concurrent projects')
+@click.option('--metrics', 'metrics_path', default=None,
+              help='export throughput per stage and type here: *.prom prometheus textfile, '
+                   '*.jsonl one snapshot per line, otherwise json')
+@click.option('--metrics_interval', default=DEFAULT_INTERVAL, help='seconds between metrics snapshots')
+@click.option('--profile', default=None, type=click.Choice(PROFILERS),
+              help='write a per stage and type breakdown and flamegraph collapsed stacks to '
+                   'output/<program>/<project>/profile.*; cprofile and sample also profile python functions')
+@click.option('--profile_interval', default=DEFAULT_SAMPLE_INTERVAL, help='seconds between --profile sample stacks')
+def import_graph(path, program, project, delete_first, output_dir, workers, loader, dsn, batch_size, incremental,
+                 import_order, concurrent_load, check_refs, validate, validate_workers, sort_edges, edge_memory,
+                 projects, metrics_path, metrics_interval, profile, profile_interval):
     """Transforms submission record to node and edge files"""
+    assert workers > 0, "workers must be positive"
+    assert edge_memory > 0, "edge_memory must be positive"
+    # a changed type is reloaded, its old rows have to go
+    assert delete_first or loader == 'diff' or not incremental, "--incremental requires --delete_first True"
+    assert not (delete_first and loader == 'diff'), "--loader diff replaces --delete_first"
+    assert not concurrent_load or (loader == 'script' and not projects), \
+        "--concurrent_load applies to the script of a single project"
+    if projects:
+        metrics = Metrics(metrics_path, metrics_interval)
+        with profiled(profile, output_dir, metrics, profile_interval):
+            jobs, failed = import_projects(projects, delete_first, output_dir, workers, loader, dsn, batch_size,
+                                           incremental, metrics, import_order, check_refs, validate, sort_edges,
+                                           edge_memory)
+        print(f"INFO imported {len(jobs) - len(failed)} of {len(jobs)} projects", file=sys.stderr)
+        report(metrics)
+        sys.exit(1 if failed else 0)
+
     assert path
     assert program, "please specify program"
     assert project, "please specify project"
-    schema = json.load(open(f"schema/{program}.json"))
-    imports = open(
-        f"{path}/{program}/{project}/DataImportOrder.txt", "r").read().splitlines()
-
-    for name in imports:
-        p = f"{path}/{program}/{project}/{name}.json"
-        tables = None
-        print(f"echo INFO reading {p}")
-        for line in reader(p):
-            assert 'type' in line, f'must have type {line}'
-            if 'project_id' not in line and line['type'] != 'project':
-                line['project_id'] = f'{program}-{project}'
-            if line['type'] != 'project':
-                assert 'submitter_id' in line, f'must have submitter_id {line}'
-            if not tables:
-                tables = get_tables(schema, line)
-                assert tables, f"echo No tables for {p} {line}?"
-                tables['handle'] = open(f"{output_dir}/{program}/{project}/{tables['node_table']}.tsv", 'w')
-                for link in tables['links']:
-                    link['handle'] = open( f"{output_dir}/{program}/{project}/{link['edge_table']}.tsv", 'w')
-                if delete_first:
-                    print(f"echo INFO deleting {program}-{project} from {tables['node_table']}")
-                    print(f"$PSQL -c \"delete from {tables['node_table']} where _props->>'project_id' = '{program}-{project}'  ;\"")
-
-            for link in tables['links']:
-                line = write_edge(link, line, f'{program}-{project}')
-            write_node(tables['handle'], line)
-
-        assert tables, f"echo No tables for {p}?"
-        tables['handle'].close()
-        node_path = f'{output_dir}/{program}/{project}/{tables["node_table"]}.tsv'
-        print(f"echo INFO importing {tables['node_table']}")
-        print(f"cat  {node_path} | $PSQL -c \"copy {tables['node_table']}(node_id, acl, _sysan,  _props) from stdin  csv delimiter E'\\t' quote E'\\x02' ;\"")
-        for link in tables['links']:
-            link['handle'].close()
-            edge_path = f"{output_dir}/{program}/{project}/{link['edge_table']}.tsv"
-            print(f"echo INFO importing {link['edge_table']}")
-            print(f"cat  {edge_path} | $PSQL -c \"copy {link['edge_table']}(src_id, dst_id, acl, _sysan, _props) from stdin  csv delimiter E'\\t' quote E'\\x02' ;\"")
+    metrics = Metrics(metrics_path, metrics_interval, labels={'program': program, 'project': project})
+    with profiled(profile, f"{output_dir}/{program}/{project}", metrics, profile_interval):
+        import_single(path, program, project, delete_first, output_dir, workers, loader, dsn, batch_size,
+                      incremental, metrics, import_order, concurrent_load, check_refs, validate, validate_workers,
+                      sort_edges, edge_memory)
+    report(metrics)
+
+
+def import_projects(projects, delete_first, output_dir, workers, loader, dsn, batch_size, incremental, metrics,
+                    import_order=DEFAULT_IMPORT_ORDER, check_refs=DEFAULT_CHECK_REFERENCES, validate=DEFAULT_VALIDATE,
+                    sort_edges=DEFAULT_SORT_EDGES, edge_memory=DEFAULT_EDGE_MEMORY):
+    """Batch mode of import_graph, returns (jobs, failed jobs)."""
+    jobs = find_projects(projects)
+    assert jobs, f"no DataImportOrder.txt or project.json found in {projects}"
+    copy_loader = Loader(dsn, batch_size, diff=loader == 'diff', metrics=metrics) if loader != 'script' else None
+    failed = import_batch(jobs, delete_first, output_dir, workers, copy_loader, incremental, metrics, import_order,
+                          check_refs, validate, sort_edges, edge_memory)
+    if copy_loader:
+        copy_loader.close()
+    return jobs, failed
+
+
+def import_single(path, program, project, delete_first, output_dir, workers, loader, dsn, batch_size, incremental,
+                  metrics, import_order=DEFAULT_IMPORT_ORDER, concurrent_load=DEFAULT_CONCURRENT_LOAD,
+                  check_refs=DEFAULT_CHECK_REFERENCES, validate=DEFAULT_VALIDATE, validate_workers=None,
+                  sort_edges=DEFAULT_SORT_EDGES, edge_memory=DEFAULT_EDGE_MEMORY):
+    """Imports one project, printing the script or loading it with loader copy/diff."""
+    plan, schema_digest = load_plan(f"schema/{program}.json", os.path.join(output_dir, PLAN_DIR))
+    imports = read_imports(path, program, project, plan, import_order)
+    check_single_pass(path, program, project, read_ahead(imports, check_refs, incremental, validate, workers))
+    if check_refs:
+        # before anything is written or loaded
+        dangling = check_references(path, program, project, plan, imports, metrics)
+        if dangling:
+            report_dangling(dangling, f"{program}-{project}")
+            sys.exit(1)
+        print(f"INFO {program}-{project}: every link resolves", file=sys.stderr)
+    manifest = None
+    if incremental:
+        # skipped types still own the program and project node ids
+        resolve_ids(path, program, project)
+        changed, manifest = select_imports(path, program, project, imports, plan, schema_digest, output_dir)
+        print(f"INFO {len(imports) - len(changed)} of {len(imports)} types unchanged, skipped", file=sys.stderr)
+        imports = changed
+    if concurrent_load:
+        levels = import_levels(plan, imports)
+        imports = [name for level in levels for name in level]
+    validation = None
+    if validate:
+        os.makedirs(f"{output_dir}/{program}/{project}", exist_ok=True)
+        # batches are validated in the background, in import order, while earlier types are transformed
+        validation = start_validation(path, program, project, imports, output_dir, validate_workers, metrics)
+
+    def rejected(name):
+        return validation.rejected(name) if validation else None
+
+    def rejects():
+        # parallel transforms need every type's rejects up front
+        return {name: validation.rejected(name) for name in imports} if validation else None
+
+    if loader != 'script':
+        copy_loader = Loader(dsn, batch_size, diff=loader == 'diff', metrics=metrics)
+        # one transaction for the whole project
+        with copy_loader.transaction() as sink:
+            if workers == 1:
+                # rows are streamed straight into COPY
+                for name in imports:
+                    transform(name, path, program, project, plan, delete_first, sink, rejected(name), sort_edges,
+                              edge_memory)
+            else:
+                for steps in transform_parallel(imports, path, program, project, plan, delete_first,
+                                                output_dir, workers, metrics, rejects(), sort_edges, edge_memory):
+                    sink.replay(steps)
+            transaction_log(sink, program, project)
+        copy_loader.close()
+        finish_validation(validation, f"{program}-{project}")
+        if manifest:
+            save_manifest(output_dir, program, project, manifest)
+        return
+
+    if manifest:
+        # a manifest is only promoted when the script got that far
+        print("set -e")
+    steps = {}
+    if workers == 1:
+        for name in imports:
+            sink = TsvSink(output_dir, program, project, metrics=metrics)
+            transform(name, path, program, project, plan, delete_first, sink, rejected(name), sort_edges, edge_memory)
+            steps[name] = sink.steps
+            if not concurrent_load:
+                print(render_script(sink.steps))
+    else:
+        transformed = transform_parallel(imports, path, program, project, plan, delete_first, output_dir, workers,
+                                         metrics, rejects(), sort_edges, edge_memory)
+        for name, type_steps in zip(imports, transformed):
+            steps[name] = type_steps
+            if not concurrent_load:
+                print(render_script(type_steps))
+    if concurrent_load:
+        print(render_levels(levels, steps))
+    sink = TsvSink(output_dir, program, project)
+    transaction_log(sink, program, project)
+    print(render_script(sink.steps))
+    finish_validation(validation, f"{program}-{project}")
+    if manifest:
+        save_manifest(output_dir, program, project, manifest, pending=True)
+        print(commit_manifest(output_dir, program, project))
+
+
+def finish_validation(validation, name):
+    """Stop the validation pool and log its outcome."""
+    if validation:
+        validation.close()
+        report_rejects(validation, name)
+
+
+def report(metrics):
+    """Export the final snapshot and log the totals when metrics are requested."""
+    if metrics.path:
+        metrics.write()
+        metrics.log()
 
-    print(f"echo INFO importing transaction_logs")
-    print(
-        f"""$PSQL -c "INSERT INTO transaction_logs(submitter, role, program, project, is_dry_run, state, closed, created_datetime, canonical_json) VALUES ('admin', 'update', \'{program}\', \'{project}\', 'f', 'SUCCEEDED', 'f', current_timestamp, '{{}}');" """)
 
-    
 if __name__ == "__main__":
     import_graph()
-
-
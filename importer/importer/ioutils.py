@@ -1,37 +1,211 @@
 """Useful io utilities."""
 
+import collections
 import json
 import gzip
 import os
 import csv
 import io
+import itertools
+import re
 import sys
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
-class JsonReader:
-    """Read json and return dict iterator."""
+# characters read per chunk when streaming a json document
+CHUNK_SIZE = 64 * 1024
+# characters peeked to detect the document format
+SNIFF_SIZE = 4 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+# uncompressed bytes per gzip member when compressing in parallel
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# bytes coalesced by BufferedWriter before writing to the file
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+# 'orjson' when installed, override with IMPORTER_JSON_CODEC=json
+JSON_CODEC = os.environ.get('IMPORTER_JSON_CODEC', 'orjson' if orjson else 'json')
+COMPACT = (',', ':')
+# finite floats orjson formats like repr(): 0 and 1e-4 <= abs(value) < 1e16, others use a different exponent
+# form ('1e16', '0.00001') and NaN and Infinity become null
+ORJSON_FLOAT_MIN = 1e-4
+ORJSON_FLOAT_MAX = 1e16
+_WHITESPACE = re.compile(r'\s*')
 
-    def __init__(self, path):
-        """Open file."""
 
-        def _open_path():
-            self.path = path
-            if path.endswith(".json.gz"):
-                self.fp = io.TextIOWrapper(io.BufferedReader(gzip.GzipFile(path)))
-            else:
-                self.fp = open(path, "r", encoding='utf-8')
-                
-        _open_path()
-        self.records = None
+def loads(s):
+    """Decode json from str or bytes with the configured codec."""
+    if JSON_CODEC == 'orjson':
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # e.g. NaN or integers beyond 64 bits, the stdlib accepts them or raises the usual error
+            pass
+    return json.loads(s)
+
+
+def _has_odd_float(obj):
+    """Whether obj is or holds a float orjson formats differently from the stdlib: NaN, infinite or extreme."""
+    kind = type(obj)
+    if kind is float:
+        # NaN compares false
+        return not (ORJSON_FLOAT_MIN <= abs(obj) < ORJSON_FLOAT_MAX or obj == 0)
+    if kind is not dict and kind is not list and kind is not tuple:
+        return False
+    for value in obj.values() if kind is dict else obj:
+        kind = type(value)
+        if kind is float:
+            if not (ORJSON_FLOAT_MIN <= abs(value) < ORJSON_FLOAT_MAX or value == 0):
+                return True
+        elif (kind is dict or kind is list or kind is tuple) and _has_odd_float(value):
+            return True
+    return False
+
+
+def dumpb(obj, separators=COMPACT):
+    """Encode obj as utf-8 json bytes, byte identical to json.dumps(obj, separators=separators).
+
+    orjson only writes compact json; strings it escapes differently (non ascii, DEL) show in its output,
+    floats are checked on obj.
+    """
+    if JSON_CODEC == 'orjson' and separators == COMPACT and not _has_odd_float(obj):
+        try:
+            out = orjson.dumps(obj)
+            if out.isascii() and b'\x7f' not in out:
+                return out
+        except TypeError:
+            # non str keys, integers beyond 64 bits
+            pass
+    return json.dumps(obj, separators=separators).encode()
+
+
+def dumps(obj, separators=COMPACT):
+    """Encode obj as json str, same as json.dumps(obj, separators=separators)."""
+    if JSON_CODEC == 'orjson' and separators == COMPACT:
+        return dumpb(obj, separators).decode()
+    return json.dumps(obj, separators=separators)
+
+
+def iter_json_array(fp, chunk_size=CHUNK_SIZE, head=''):
+    """Incrementally decode a top level json array from a text stream.
+
+    Records are yielded one at a time, at most one record plus one chunk is
+    held in memory.  A document that is not an array yields its value as is.
+    As json.load, anything but whitespace after the document is an error.
+    `head` is text already consumed from `fp`, e.g. while sniffing the format.
+    """
+    decoder = json.JSONDecoder()
+    buf = head
+    pos = 0
+    eof = False
+    # None before the document, then what the grammar expects next:
+    # 'first' element or ']', 'element', 'separator' (',' or ']'), 'end' of input
+    state = None
+    need = chunk_size
+    while True:
+        # skip whitespace, refilling the buffer as needed
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                break
+            chunk = fp.read(chunk_size)
+            buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+        if pos >= len(buf):
+            if state is None:
+                raise json.decoder.JSONDecodeError('Expecting value', buf, pos)
+            if state != 'end':
+                raise json.decoder.JSONDecodeError('Unterminated array', buf, pos)
+            return
+        char = buf[pos]
+        if state == 'end':
+            raise json.decoder.JSONDecodeError('Extra data', buf, pos)
+        if state is None and char == '[':
+            state = 'first'
+            pos += 1
+            continue
+        if state in ('first', 'separator') and char == ']':
+            state = 'end'
+            pos += 1
+            continue
+        if state == 'separator':
+            if char != ',':
+                raise json.decoder.JSONDecodeError("Expecting ',' delimiter", buf, pos)
+            state = 'element'
+            pos += 1
+            continue
         try:
-            json.loads(self.fp.readline())
-            _open_path()
+            obj, end = decoder.raw_decode(buf, pos)
+            # a bare number may be truncated at the buffer edge, e.g. '3.' of '3.5'
+            complete = eof or (end < len(buf) and (
+                isinstance(obj, (dict, list, str)) or buf[end] in ' \t\n\r,]'))
         except json.decoder.JSONDecodeError:
-            _open_path()
-            self.records = json.load(self.fp)
-            if not isinstance(self.records, list):
-                self.records = [self.records]
+            if eof:
+                raise
+            complete = False
+        if not complete:
+            # grow reads geometrically so a single large record stays linear
+            chunk = fp.read(need)
+            buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+            need *= 2
+            continue
+        need = chunk_size
+        pos = end
+        state = 'end' if state is None else 'separator'
+        yield obj
+
+
+def open_stream(source):
+    """Open a path, '-' for stdin or a binary file object as utf-8 text.
+
+    Gzip is detected from the magic number on a peeked buffer, so pipes and
+    other non-seekable inputs work and nothing is read twice.
+    """
+    if source == '-':
+        fp = sys.stdin.buffer
+    elif isinstance(source, str):
+        fp = open(source, 'rb')
+    else:
+        fp = source
+    if not hasattr(fp, 'peek'):
+        fp = io.BufferedReader(fp)
+    if fp.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        fp = io.BufferedReader(gzip.GzipFile(fileobj=fp, mode='rb'))
+    return io.TextIOWrapper(fp, encoding='utf-8')
+
+
+def sniff_format(head):
+    """Return 'array', 'ndjson' or 'object' for the start of a json document."""
+    head = head.lstrip()
+    if head.startswith('['):
+        return 'array'
+    try:
+        json.loads(head.partition('\n')[0])
+        return 'ndjson'
+    except json.decoder.JSONDecodeError:
+        return 'object'
+
+
+class JsonReader:
+    """Read json and return dict iterator."""
+
+    def __init__(self, path):
+        """Open file, path may also be '-' (stdin) or a binary file object."""
+        self.path = path
+        self.fp = open_stream(path)
+        # peek once, completing the first line unless it may hold a whole array
+        head = self.fp.read(SNIFF_SIZE)
+        if not head.lstrip().startswith('['):
+            head += self.fp.readline()
+        self.format = sniff_format(head)
+        if self.format == 'ndjson':
+            self.records = (
+                loads(line) for line in itertools.chain(io.StringIO(head), self.fp) if line.strip()
+            )
+        else:
+            self.records = iter_json_array(self.fp, head=head)
 
     def __iter__(self):
         """Return self."""
@@ -39,16 +213,7 @@ class JsonReader:
 
     def __next__(self):
         """Iterate to next row."""
-        if self.records:
-            return self.records.pop(0)
-
-        try:
-            line = self.fp.readline()
-            if len(line) < 1:
-                raise IndexError()
-            return json.loads(line)
-        except IndexError:
-            raise StopIteration()
+        return next(self.records)
 
 
 def ensure_directory(*args):
@@ -64,7 +229,9 @@ def ensure_directory(*args):
 
 def reader(path, **kwargs):
     """Wrap gzip if necessary."""
-    if path.endswith(".json.gz"):
+    if path == '-':
+        return JsonReader(path)
+    elif path.endswith(".json.gz"):
         return JsonReader(path)
     elif path.endswith(".gz"):
         return io.TextIOWrapper(
@@ -82,60 +249,150 @@ def reader(path, **kwargs):
         return open(path, "r", encoding='utf-8')
 
 
-class Rate:
-    """Writes progress to stderr."""
+class BufferedWriter:
+    """Coalesces rows into a reusable bytearray, written to fileobj in buffer_size chunks.
+
+    A row is one write() of one or more str/bytes chunks; rows and bytes written are
+    counted so callers can report throughput, see rates().
+    """
+
+    def __init__(self, fileobj, buffer_size=DEFAULT_BUFFER_SIZE):
+        """Allocate the buffer once, fileobj must accept bytes."""
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        # a view pins the buffer size, slices are written without copies
+        self.view = memoryview(self.buffer)
+        self.position = 0
+        self.rows = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.seconds = None
+
+    @property
+    def name(self):
+        """Name of the underlying file."""
+        return getattr(self.fileobj, 'name', None)
 
-    def __init__(self):
-        """Initialize class vars."""
-        self.i = 0
-        self.start = None
-        self.first = None
+    def write(self, *chunks):
+        """Buffer one row."""
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            size = len(chunk)
+            if self.position + size > self.buffer_size:
+                self.flush()
+                if size > self.buffer_size:
+                    self.fileobj.write(chunk)
+                    self.bytes += size
+                    continue
+            self.view[self.position:self.position + size] = chunk
+            self.position += size
+        self.rows += 1
+
+    def flush(self):
+        """Write the buffered bytes."""
+        if self.position:
+            self.fileobj.write(self.view[:self.position])
+            self.bytes += self.position
+            self.position = 0
 
     def close(self):
-        """Write final stats."""
-        if self.i == 0:
-            return
+        """Flush and close the file."""
+        self.flush()
+        self.view.release()
+        self.fileobj.close()
+        self.seconds = time.monotonic() - self.start
 
-        self.log()
-        dt = datetime.now() - self.first
-        m = "\ntotal: {0:,} in {1:,d} seconds".format(self.i,
-                                                      int(dt.total_seconds()))
-        print(m, file=sys.stderr)
+    def rates(self):
+        """Rows and bytes written, with their per second rates."""
+        seconds = self.seconds if self.seconds is not None else time.monotonic() - self.start
+        return {
+            'rows': self.rows,
+            'bytes': self.bytes + self.position,
+            'seconds': seconds,
+            'rows_per_sec': self.rows / max(seconds, 1e-9),
+            'bytes_per_sec': (self.bytes + self.position) / max(seconds, 1e-9),
+        }
 
-    def log(self):
-        """Write stats."""
-        if self.i == 0:
-            return
+    # support 'with...'
+    def __enter__(self):
+        """Set things up."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Tear things down."""
+        self.close()
 
-        dt = datetime.now() - self.start
-        self.start = datetime.now()
-        rate = 1000 / dt.total_seconds()
-        m = "rate: {0:,} emitted ({1:,d}/sec)".format(self.i, int(rate))
-        print("\r" + m, end='', file=sys.stderr)
 
-    def tick(self):
-        """Increment stats."""
-        if self.start is None:
-            self.start = datetime.now()
-            self.first = self.start
+def gzip_member(data, compresslevel):
+    """A complete gzip member, 0 mtime and no file name so identical data gives identical bytes."""
+    out = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=compresslevel, fileobj=out, mtime=0) as fh:
+        fh.write(data)
+    return out.getvalue()
 
-        self.i += 1
 
-        if self.i % 1000 == 0:
-            self.log()
+class ParallelGzipWriter:
+    """Binary writer compressing fixed size blocks into independent gzip members on a thread pool.
+
+    The output is a standard multi-member gzip (gunzip, zcat and gzip.open read it) and is
+    byte identical for a given block_size and compresslevel, whatever the number of threads.
+    """
+
+    def __init__(self, fileobj, compresslevel=9, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+        """Start the pool."""
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.threads = threads or os.cpu_count()
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.members = 0
+
+    def write(self, data):
+        """Buffer data, submitting every full block."""
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+    def _submit(self, block):
+        # zlib releases the GIL, blocks compress concurrently; members are written in order
+        self.pending.append(self.executor.submit(gzip_member, block, self.compresslevel))
+        self.members += 1
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        """Compress the last partial block, write all members and close the file."""
+        if self.buffer or self.members == 0:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.fileobj.close()
 
 
 class JSONEmitter():
     """Writes objects to disk as json, defaults to gz."""
 
-    def __init__(self, path, append=False, compresslevel=9):
-        """Ensure path exists, set compresslevel=0 or path contains gz to skip compression."""
+    def __init__(self, path, append=False, compresslevel=9, block_size=None, threads=None,
+                 buffer_size=DEFAULT_BUFFER_SIZE, metrics=None):
+        """Ensure path exists, set compresslevel=0 or path contains gz to skip compression.
+
+        Set block_size to compress blocks of that many bytes on threads, see ParallelGzipWriter.
+        Lines are coalesced in buffer_size chunks, see BufferedWriter.
+        Lines written are added to the write stage of metrics, or logged to stderr on close.
+        """
         self.path = path
         self.compresslevel = compresslevel
-        self.rate = Rate()
-        mode = 'wt'
+        self.metrics = metrics
+        mode = 'wb'
         if append:
-            mode = 'at'
+            mode = 'ab'
         ensure_directory(os.path.dirname(path))
         if compresslevel == 0 and not path.endswith('.gz'):
             self.fh = open(path, mode=mode)
@@ -145,27 +402,36 @@ class JSONEmitter():
                 self.path = path + '.gz'
             # write with 0 mtime (ensures identical file each run)
             # in turn ensures md5 hash identical
-            self.fh = gzip.GzipFile(
-                filename='',
-                compresslevel=self.compresslevel,
-                fileobj=open(self.path, mode='wb'),
-                mtime=0
-            )
+            if block_size:
+                self.fh = ParallelGzipWriter(
+                    open(self.path, mode=mode),
+                    compresslevel=self.compresslevel,
+                    block_size=block_size,
+                    threads=threads,
+                )
+            else:
+                self.fh = gzip.GzipFile(
+                    filename='',
+                    compresslevel=self.compresslevel,
+                    fileobj=open(self.path, mode='wb'),
+                    mtime=0
+                )
+        self.writer = BufferedWriter(self.fh, buffer_size=buffer_size)
 
     def write(self, obj):
         """Write object as json + newline."""
-        if self.compresslevel > 0:
-            self.fh.write(json.dumps(obj).encode())
-            self.fh.write('\n'.encode())
-        else:
-            self.fh.write(json.dumps(obj))
-            self.fh.write('\n')
-        self.rate.tick()
+        # the stdlib's default separators keep existing md5s, orjson cannot write them
+        self.writer.write(dumpb(obj, separators=None), b'\n')
 
     def close(self):
         """Close the file."""
-        self.fh.close()
-        self.rate.close()
+        self.writer.close()
+        rates = self.writer.rates()
+        if self.metrics:
+            self.metrics.add('write', os.path.basename(self.path), rates['rows'], rates['bytes'], rates['seconds'])
+        elif rates['rows']:
+            print(f"total: {rates['rows']:,} in {rates['seconds']:.1f} seconds"
+                  f" ({int(rates['rows_per_sec']):,}/sec)", file=sys.stderr)
 
     # support 'with...'
     def __enter__(self):
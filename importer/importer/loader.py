@@ -0,0 +1,263 @@
+"""Loads node and edge rows straight into postgres with COPY, bypassing the generated psql script."""
+import io
+import os
+import sys
+from contextlib import contextmanager
+
+from importer.ioutils import BufferedWriter
+from importer.metrics import Metrics
+
+try:
+    import psycopg2
+    from psycopg2.pool import SimpleConnectionPool
+except ImportError:  # pragma: no cover
+    psycopg2 = None
+
+COPY_OPTIONS = "csv delimiter E'\\t' quote E'\\x02'"
+# the program node is carried by every project of a program, each load upserts it
+SHARED_TABLES = ('node_program',)
+
+
+def default_dsn():
+    """Connection string from the PG_* variables shared with docker-compose."""
+    return "host={} dbname={} user={} password={}".format(
+        os.environ.get('PG_HOST', 'localhost'),
+        os.environ.get('PG_NAME', 'metadata'),
+        os.environ.get('PG_USER', 'metadata'),
+        os.environ.get('PG_PASS', 'metadata'),
+    )
+
+
+def copy_statement(table, columns):
+    """The COPY statement shared by the script and the loader."""
+    return f"copy {table}({columns}) from stdin  {COPY_OPTIONS} ;"
+
+
+def upsert_statement(table, columns, stage):
+    """Inserts the staged nodes, updating those whose properties changed; created_datetime is kept.
+
+    Timestamps default to now() when missing in the submission, they do not make a change.
+    """
+    return (f"insert into {table} as t ({columns}) select {columns} from {stage}"
+            " on conflict (node_id) do update set acl = excluded.acl, _sysan = excluded._sysan,"
+            " _props = excluded._props || jsonb_strip_nulls("
+            "jsonb_build_object('created_datetime', t._props->'created_datetime'))"
+            " where (t._props - 'created_datetime' - 'updated_datetime')"
+            " is distinct from (excluded._props - 'created_datetime' - 'updated_datetime')")
+
+
+def shared_copy_statements(table, columns):
+    """Statements loading a shared table through a staging table, upserting rows already there.
+
+    One session: the script runs them as -c options of a single psql.
+    """
+    stage = f"stage_{table}"
+    return [
+        f"create temp table if not exists {stage} (like {table} including defaults)",
+        copy_statement(stage, columns),
+        f"{upsert_statement(table, columns, stage)} ; truncate {stage}",
+    ]
+
+
+class CopyWriter:
+    """File like handle, buffers tsv rows and COPYs them into a table every batch_size rows.
+
+    Followers (the edge tables of a node table) are flushed right after it, never on their
+    own, so an edge row is never copied before the node row it references. Once it is closed
+    they take its batch_size: sorted edges are only written after their node table is closed.
+    """
+
+    def __init__(self, loader, table, columns, batch_size=None):
+        """Set up buffer."""
+        self.loader = loader
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size
+        self.buffer = io.BytesIO()
+        self.writer = BufferedWriter(self.buffer)
+        self.pending = 0
+        self.rows = 0
+        self.followers = []
+
+    def write(self, *chunks):
+        """Buffer one row, flushing a full batch."""
+        self.writer.write(*chunks)
+        self.pending += 1
+        if self.batch_size and self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """COPY buffered rows, then those of followers."""
+        self._copy()
+        for follower in self.followers:
+            follower.flush()
+
+    def _copy(self):
+        if self.pending == 0:
+            return
+        self.writer.flush()
+        self.buffer.seek(0)
+        self.loader.copy_from(self.table, self.columns, self.buffer)
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.rows += self.pending
+        self.pending = 0
+
+    def close(self):
+        """Flush remaining rows, followers now flush full batches on their own."""
+        self.flush()
+        for follower in self.followers:
+            follower.batch_size = self.batch_size
+
+    def rates(self):
+        """Rows and bytes written, see BufferedWriter.rates()."""
+        return self.writer.rates()
+
+
+class Loader:
+    """Executes import steps over one pooled connection, one transaction per project.
+
+    Implements the same sink interface as importer.TsvSink, so transform() can
+    stream rows into it directly.
+
+    With diff, every table is COPYed into a temporary staging table, then only new and
+    changed rows are upserted and the project's rows missing from the stage are deleted.
+    """
+
+    def __init__(self, dsn=None, batch_size=100, diff=False, metrics=None):
+        """Open the pool, COPY and merge times are added to the load stage of metrics."""
+        assert psycopg2, "the copy loader requires psycopg2, pip install importer[postgres]"
+        self.pool = SimpleConnectionPool(1, 1, dsn or default_dsn())
+        self.batch_size = batch_size
+        self.diff = diff
+        self.metrics = metrics or Metrics()
+        self.cursor = None
+        self.node_writer = None
+        self.node_table = None
+        self.type = None
+        self.where = None
+        # table -> {'inserted': n, 'updated': n, 'deleted': n}, diff only
+        self.stats = {}
+
+    @contextmanager
+    def transaction(self):
+        """Commit on success, rollback on error."""
+        connection = self.pool.getconn()
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    self.cursor = cursor
+                    yield self
+        finally:
+            self.cursor = None
+            self.pool.putconn(connection)
+
+    def close(self):
+        """Close the pool."""
+        self.pool.closeall()
+
+    def echo(self, message):
+        """Progress goes to stderr, stdout stays a (now empty) script."""
+        print(f"INFO {message}", file=sys.stderr)
+
+    def sql(self, statement):
+        """Execute a statement."""
+        self.cursor.execute(statement)
+
+    def scope(self, type, table, where):
+        """Type and node table of the rows that follow, where selects the project's existing rows."""
+        self.type = type
+        self.node_table = table
+        self.where = where
+
+    def open(self, table, columns):
+        """Rows are streamed to COPY, nothing is written to disk.
+
+        transform() opens a type's node table first, its edge tables follow it.
+        """
+        if self.diff:
+            self.stage(table)
+        if table.startswith('node_'):
+            self.node_writer = CopyWriter(self, table, columns, self.batch_size)
+            return self.node_writer
+        writer = CopyWriter(self, table, columns)
+        self.node_writer.followers.append(writer)
+        return writer
+
+    def copy(self, table, columns, handle):
+        """Flush the streamed rows."""
+        handle.close()
+        if self.diff:
+            self.merge(table, columns)
+
+    def stage(self, table):
+        """Create or empty the staging table of table."""
+        self.cursor.execute(
+            f"create temp table if not exists stage_{table} (like {table} including defaults) on commit drop ;"
+            f" truncate stage_{table}")
+
+    def merge(self, table, columns):
+        """Apply the staged rows of table, counting inserted, updated and deleted rows."""
+        with self.metrics.span('load', self.type):
+            stats = self._merge(table, columns)
+        self.stats[table] = stats
+        self.echo(f"{table}: inserted {stats['inserted']}, updated {stats['updated']}, deleted {stats['deleted']}")
+
+    def _merge(self, table, columns):
+        stage = f"stage_{table}"
+        stats = {'inserted': 0, 'updated': 0, 'deleted': 0}
+        if table == self.node_table:
+            self.cursor.execute(f"{upsert_statement(table, columns, stage)} returning xmax = 0")
+            inserted = [row[0] for row in self.cursor.fetchall()]
+            stats['inserted'] = sum(inserted)
+            stats['updated'] = len(inserted) - stats['inserted']
+            if self.where:
+                self.cursor.execute(
+                    f"delete from {table} t where {self.where}"
+                    f" and not exists (select 1 from {stage} s where s.node_id = t.node_id)")
+                stats['deleted'] = self.cursor.rowcount
+        else:
+            self.cursor.execute(f"insert into {table}({columns}) select {columns} from {stage} on conflict do nothing")
+            stats['inserted'] = self.cursor.rowcount
+            # edges of the staged nodes that are no longer submitted
+            self.cursor.execute(
+                f"delete from {table} e using stage_{self.node_table} n where e.src_id = n.node_id"
+                f" and not exists (select 1 from {stage} s where s.src_id = e.src_id and s.dst_id = e.dst_id)")
+            stats['deleted'] = self.cursor.rowcount
+        return stats
+
+    def copy_from(self, table, columns, fp):
+        """COPY tsv rows from fp into table, or its staging table."""
+        with self.metrics.span('load', self.type) as loaded:
+            self._copy_from(table, columns, fp)
+            loaded.items += max(self.cursor.rowcount, 0)
+
+    def _copy_from(self, table, columns, fp):
+        if self.diff:
+            self.cursor.copy_expert(copy_statement(f"stage_{table}", columns), fp)
+            return
+        if table not in SHARED_TABLES:
+            self.cursor.copy_expert(copy_statement(table, columns), fp)
+            return
+        create, copy, insert = shared_copy_statements(table, columns)
+        self.cursor.execute(create)
+        self.cursor.copy_expert(copy, fp)
+        self.cursor.execute(insert)
+
+    def replay(self, steps):
+        """Execute steps recorded by a TsvSink, e.g. in a worker process."""
+        for step in steps:
+            if step[0] == 'echo':
+                self.echo(step[1])
+            elif step[0] == 'sql':
+                self.sql(step[1])
+            elif step[0] == 'scope':
+                self.scope(*step[1:])
+            elif step[0] == 'copy':
+                _, table, columns, path = step
+                if self.diff:
+                    self.stage(table)
+                with open(path, 'r') as handle:
+                    self.copy_from(table, columns, handle)
+                if self.diff:
+                    self.merge(table, columns)
@@ -0,0 +1,170 @@
+"""Import throughput metrics: monotonic counters per stage and node type, periodic snapshots and exporters.
+
+Stages are check (the optional referential integrity pass), validate (waiting on the optional schema
+validation of a type), read (decoding input records), transform (building node and edge rows), write
+(flushing tsv files or COPY buffers) and load (postgres COPY and merges). They do not overlap, a COPY
+streamed while rows are built or flushed is counted as load only. Export formats follow the file name:
+*.prom is a prometheus node_exporter textfile, *.jsonl appends one snapshot per line, anything else is
+overwritten with the latest json snapshot.
+"""
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+STAGES = ('check', 'validate', 'read', 'transform', 'write', 'load')
+# seconds between periodic snapshots
+DEFAULT_INTERVAL = 10.0
+PROMETHEUS_PREFIX = 'importer'
+
+
+class Counter:
+    """Items, bytes and seconds accumulated by one stage of one type."""
+
+    __slots__ = ('items', 'bytes', 'seconds')
+
+    def __init__(self, items=0, bytes=0, seconds=0.0):
+        """Start at zero."""
+        self.items = items
+        self.bytes = bytes
+        self.seconds = seconds
+
+
+class Metrics:
+    """Counters keyed by (stage, type), cheap enough to update per record."""
+
+    def __init__(self, path=None, interval=DEFAULT_INTERVAL, labels=None):
+        """path receives the snapshots, none are written without it."""
+        self.path = path
+        self.interval = interval
+        self.labels = labels or {}
+        self.counters = {}
+        self.start = time.monotonic()
+        self.last = self.start
+
+    def counter(self, stage, type):
+        """The counter of stage and type, hold on to it in hot loops."""
+        key = (stage, type)
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters[key] = Counter()
+        return counter
+
+    def add(self, stage, type, items=0, bytes=0, seconds=0.0):
+        """Accumulate into a counter."""
+        counter = self.counter(stage, type)
+        counter.items += items
+        counter.bytes += bytes
+        counter.seconds += seconds
+
+    @contextmanager
+    def span(self, stage, type):
+        """Time a block, yields its counter so items and bytes can be added."""
+        counter = self.counter(stage, type)
+        start = time.perf_counter()
+        try:
+            yield counter
+        finally:
+            counter.seconds += time.perf_counter() - start
+
+    def timed_iter(self, stage, type, iterable):
+        """Yields from iterable, counting the items and the time spent producing them."""
+        counter = self.counter(stage, type)
+        clock = time.perf_counter
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                counter.seconds += clock() - start
+                return
+            counter.seconds += clock() - start
+            counter.items += 1
+            yield item
+
+    def dump(self):
+        """Counters as plain lists, to ship across processes."""
+        return [[stage, type, c.items, c.bytes, c.seconds] for (stage, type), c in self.counters.items()]
+
+    def merge(self, counters):
+        """Add counters returned by dump(), e.g. from a worker process."""
+        for stage, type, items, bytes, seconds in counters or []:
+            self.add(stage, type, items, bytes, seconds)
+
+    def snapshot(self):
+        """Point in time view of all counters, with rates."""
+        elapsed = time.monotonic() - self.start
+        counters = []
+        for (stage, type), c in sorted(self.counters.items(), key=lambda item: (_stage_order(item[0][0]), item[0][1])):
+            counters.append({
+                'stage': stage, 'type': type, 'items': c.items, 'bytes': c.bytes, 'seconds': round(c.seconds, 6),
+                'items_per_sec': round(c.items / c.seconds, 1) if c.seconds else None,
+            })
+        return {'timestamp': time.time(), 'elapsed': round(elapsed, 6), 'labels': self.labels, 'counters': counters}
+
+    def maybe_snapshot(self):
+        """Write a snapshot if interval seconds passed since the last one."""
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.write()
+
+    def write(self):
+        """Export a snapshot to path."""
+        if not self.path:
+            return
+        snapshot = self.snapshot()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.path.endswith('.jsonl'):
+            with open(self.path, 'a') as fp:
+                fp.write(json.dumps(snapshot) + '\n')
+            return
+        content = to_prometheus(snapshot) if self.path.endswith('.prom') else json.dumps(snapshot, indent=2)
+        # node_exporter may read the file at any time, replace it atomically
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as fp:
+            fp.write(content)
+        os.replace(tmp_path, self.path)
+
+    def log(self, file=sys.stderr):
+        """Per stage totals, and the slowest type of each stage."""
+        for stage in sorted({stage for stage, _ in self.counters}, key=_stage_order):
+            counters = {type: c for (s, type), c in self.counters.items() if s == stage}
+            items = sum(c.items for c in counters.values())
+            seconds = sum(c.seconds for c in counters.values())
+            slowest = max(counters, key=lambda type: counters[type].seconds)
+            print(f"INFO {stage}: {items:,} items in {seconds:.3f}s,"
+                  f" slowest {slowest} {counters[slowest].seconds:.3f}s", file=file)
+
+
+def _stage_order(stage):
+    return STAGES.index(stage) if stage in STAGES else len(STAGES)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus(snapshot):
+    """Renders a snapshot in the prometheus text exposition format."""
+    lines = []
+    for name, help, field in (('items_total', 'Items processed.', 'items'),
+                              ('bytes_total', 'Bytes processed.', 'bytes'),
+                              ('seconds_total', 'Seconds spent.', 'seconds')):
+        metric = f"{PROMETHEUS_PREFIX}_{name}"
+        lines.append(f"# HELP {metric} {help}")
+        lines.append(f"# TYPE {metric} counter")
+        for counter in snapshot['counters']:
+            labels = dict(snapshot['labels'], stage=counter['stage'], type=counter['type'])
+            rendered = ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+            lines.append(f"{metric}{{{rendered}}} {counter[field]}")
+    rendered = ','.join(f'{key}="{_escape(value)}"' for key, value in snapshot['labels'].items())
+    rendered = f"{{{rendered}}}" if rendered else ''
+    lines.append(f"# HELP {PROMETHEUS_PREFIX}_elapsed_seconds Seconds since the import started.")
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}_elapsed_seconds gauge")
+    lines.append(f"{PROMETHEUS_PREFIX}_elapsed_seconds{rendered} {snapshot['elapsed']}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,105 @@
+"""Compiled import plan, per type: node table, ordered links with their edge tables and required fields.
+
+Plans are cached on disk keyed by the hash of the schema file, so repeated imports skip schema walking.
+"""
+import hashlib
+import json
+import os
+
+from importer.gen3 import generate_edge_tablename, get_class_tablename_from_id
+
+# bump when the plan layout changes, invalidates cached plans
+PLAN_VERSION = 1
+
+
+def compile_type(schema, type):
+    """Consolidates node and edge table names for one type."""
+    assert f"{type}.yaml" in schema.keys(), f'{type} not found in schema'
+    type_schema = schema[f"{type}.yaml"]
+    assert 'id' in type_schema, f'{type} not found in schema {type_schema}'
+    assert type == type_schema['id'], f'schema id should be the same as type {type}'
+    tables = {
+        'node_table': get_class_tablename_from_id(type),
+        'links': [],
+        'required': type_schema.get('required', []),
+    }
+    for link in _flatten(type_schema.get('links', [])):
+        tables['links'].append({
+            'src_edge_property': link['name'],
+            'edge_table': generate_edge_tablename(type, link['label'], link['target_type']),
+            'target_type': link['target_type'],
+        })
+    return tables
+
+
+def _flatten(links):
+    """Links with subgroups expanded, in schema order."""
+    for link in links:
+        if 'subgroup' in link:
+            yield from _flatten(link['subgroup'])
+        else:
+            yield link
+
+
+def compile_plan(schema):
+    """Compiles every node type of a schema."""
+    return {
+        key[:-len('.yaml')]: compile_type(schema, key[:-len('.yaml')])
+        for key, value in schema.items()
+        if not key.startswith('_') and isinstance(value, dict) and 'id' in value
+    }
+
+
+def load_plan(schema_path, cache_dir):
+    """Returns (plan, schema digest), compiling and caching the plan on a miss."""
+    with open(schema_path, 'rb') as fp:
+        content = fp.read()
+    digest = hashlib.sha256(content).hexdigest()
+    name = os.path.splitext(os.path.basename(schema_path))[0]
+    cache_path = os.path.join(cache_dir, f"{name}-{digest[:16]}-v{PLAN_VERSION}.json")
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'r') as fp:
+            return json.load(fp), digest
+    plan = compile_plan(json.loads(content))
+    os.makedirs(cache_dir, exist_ok=True)
+    # write then rename, concurrent imports may race on the same plan
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as fp:
+        json.dump(plan, fp)
+    os.replace(tmp_path, cache_path)
+    return plan, digest
+
+
+def import_levels(plan, types):
+    """Groups types into dependency levels: a type comes after every type of types it links to.
+
+    Types of one level do not link to each other, they can be transformed and loaded concurrently.
+    Links to the type itself or to types outside types are not dependencies.
+    """
+    types = set(types)
+    assert types <= set(plan), f"{sorted(types - set(plan))} not found in schema"
+    dependencies = {
+        type: {link['target_type'] for link in plan[type]['links']} & types - {type}
+        for type in types
+    }
+    levels = []
+    done = set()
+    while len(done) < len(types):
+        level = sorted(type for type in types - done if dependencies[type] <= done)
+        assert level, f"link cycle between {sorted(types - done)}"
+        levels.append(level)
+        done.update(level)
+    return levels
+
+
+def import_order(plan, types):
+    """Types in load order, the levels of import_levels flattened."""
+    return [type for level in import_levels(plan, types) for type in level]
+
+
+def plan_tables(plan, line):
+    """Fresh copy of a type's tables, ready to have handles attached."""
+    assert 'type' in line, 'no "type" in record {}'.format(line)
+    assert line['type'] in plan, f"{line['type']} not found in schema"
+    tables = plan[line['type']]
+    return {'node_table': tables['node_table'], 'links': [dict(link) for link in tables['links']]}
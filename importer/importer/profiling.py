@@ -0,0 +1,127 @@
+"""Profiles an import: per stage and per type span breakdown, optionally cProfile or a stack sampler.
+
+Writes to the project's output directory:
+
+* profile.txt        seconds per stage and per type (from importer.metrics), the cProfile top functions
+* profile.collapsed  flamegraph collapsed stacks, `flamegraph.pl profile.collapsed > profile.svg`,
+                     sampled python stacks with `sample`, otherwise import;<stage>;<type> spans in microseconds
+* profile.pstats     cProfile statistics with `cprofile`, e.g. for snakeviz
+"""
+import cProfile
+import collections
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from importer.metrics import STAGES
+
+PROFILERS = ('spans', 'cprofile', 'sample')
+# seconds between stack samples
+DEFAULT_SAMPLE_INTERVAL = 0.001
+# functions listed in profile.txt with cprofile
+TOP_FUNCTIONS = 30
+
+
+class Sampler:
+    """Samples the python stack of one thread from a daemon thread, counting collapsed stacks.
+
+    Work done in worker processes (--workers > 1) is not sampled, only its wait in the parent.
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL, thread_id=None):
+        """Sample thread_id, the calling thread by default."""
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='importer-sampler', daemon=True)
+
+    def start(self):
+        """Start sampling."""
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling."""
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+def breakdown(metrics, wall):
+    """Seconds per stage and per type of each stage, with their share of the wall time."""
+    lines = [f"wall {wall:.3f}s", '']
+    stages = collections.defaultdict(dict)
+    for (stage, type), counter in metrics.counters.items():
+        stages[stage][type] = counter
+    for stage in sorted(stages, key=lambda stage: STAGES.index(stage) if stage in STAGES else len(STAGES)):
+        types = stages[stage]
+        seconds = sum(counter.seconds for counter in types.values())
+        lines.append(f"{stage:<12}{seconds:>10.3f}s {100 * seconds / max(wall, 1e-9):>6.1f}%")
+        for type, counter in sorted(types.items(), key=lambda item: -item[1].seconds):
+            lines.append(f"  {type:<30}{counter.seconds:>10.3f}s {100 * counter.seconds / max(wall, 1e-9):>6.1f}%"
+                         f"  {counter.items:>10,} items")
+    return '\n'.join(lines) + '\n'
+
+
+def span_stacks(metrics):
+    """Spans as collapsed stacks, microseconds per import;<stage>;<type>."""
+    return {f"import;{stage};{type}": int(counter.seconds * 1e6)
+            for (stage, type), counter in metrics.counters.items() if counter.seconds}
+
+
+def write_collapsed(path, stacks):
+    """Writes stacks in the collapsed format read by flamegraph.pl and speedscope."""
+    with open(path, 'w') as fp:
+        for stack, count in sorted(stacks.items()):
+            if count:
+                fp.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def profiled(mode, directory, metrics, interval=DEFAULT_SAMPLE_INTERVAL):
+    """Profiles the block with mode (None to skip), writing the reports to directory."""
+    if not mode:
+        yield
+        return
+    assert mode in PROFILERS, f"unknown profiler {mode}"
+    profiler = cProfile.Profile() if mode == 'cprofile' else None
+    sampler = Sampler(interval) if mode == 'sample' else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    if sampler:
+        sampler.start()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        if sampler:
+            sampler.stop()
+        wall = time.perf_counter() - start
+        os.makedirs(directory, exist_ok=True)
+        report = breakdown(metrics, wall)
+        if profiler:
+            profiler.dump_stats(os.path.join(directory, 'profile.pstats'))
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+            report += '\n' + out.getvalue()
+        with open(os.path.join(directory, 'profile.txt'), 'w') as fp:
+            fp.write(report)
+        write_collapsed(os.path.join(directory, 'profile.collapsed'),
+                        sampler.stacks if sampler else span_stacks(metrics))
+        print(f"INFO profile written to {directory}/profile.*", file=sys.stderr)
@@ -0,0 +1,281 @@
+"""Simulates a project's submission from schema/<program>.json, natively instead of the data-simulator container.
+
+Types are generated in import order (see importer.plan), every record gets the required properties
+(and, unless required_only, the optional ones) drawn from their enum, type, bounds or pattern, and links
+to records of the types it points at according to the link's multiplicity.  The number of records of each type is known up front,
+so types are generated independently, in parallel, each with its own seeded random generator: the output
+only depends on the seed, not on the number of workers.
+"""
+import os
+import random
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+from importer.dictionary import ResolvedDictionary, links_of
+from importer.ioutils import DEFAULT_BLOCK_SIZE, BufferedWriter, ParallelGzipWriter, dumpb, ensure_directory, loads
+from importer.plan import compile_plan, import_order
+
+DEFAULT_PATH = 'data'
+DEFAULT_PROJECT = 'simulated'
+DEFAULT_MAX_SAMPLES = 10
+DEFAULT_SEED = 0
+# gzip compression level of the type files, 0 writes plain ndjson
+DEFAULT_COMPRESSLEVEL = 0
+# compression threads per type file
+GZIP_THREADS = 2
+# items of generated arrays and targets of many_to_many links
+MAX_ITEMS = 3
+# properties set by the importer or the submission service, never generated
+SKIPPED = {'type', 'id', 'submitter_id', 'project_id', 'state', 'created_datetime', 'updated_datetime'}
+_PATTERN_TOKEN = re.compile(r'\[([^\]]+)\](?:\{(\d+)\})?|\\(.)|([^\^\$])')
+
+
+def simulated_types(dictionary):
+    """Types linking, directly or not, to project and the types they link to."""
+    ids = {dictionary.documents[name]['id']: name for name in dictionary.nodes()}
+    targets = {_id: {link['target_type'] for link in links_of(dictionary.documents[name])
+                     if link.get('target_type') in ids}
+               for _id, name in ids.items()}
+    types = {'project'}
+    changed = True
+    while changed:
+        changed = False
+        for _id, linked in targets.items():
+            if _id not in types and types.intersection(linked):
+                types.add(_id)
+                changed = True
+            if _id in types and not types.issuperset(linked):
+                types.update(linked)
+                changed = True
+    return types
+
+
+def submitter_id(project, type, i):
+    """submitter_id of the i-th record of a type."""
+    return f"{project}-{type}-{i}"
+
+
+def pattern_generator(pattern):
+    """Function of rng generating strings matching a simple pattern (literals and [classes]{n}), None otherwise."""
+    if any(c in pattern for c in '()|*+?.'):
+        return None
+    parts = []
+    for klass, count, escaped, literal in _PATTERN_TOKEN.findall(pattern):
+        if klass:
+            alphabet = ''.join(chr(c) for a, _, b in re.findall(r'(.)(-(.))?', klass)
+                               for c in range(ord(a), ord(b or a) + 1))
+            parts.append((alphabet, int(count or 1)))
+        else:
+            parts.append((escaped or literal, 0))
+    return lambda rng: ''.join(''.join(rng.choices(part, k=count)) if count else part for part, count in parts)
+
+
+def value_generator(name, schema):
+    """Function of (rng, i) generating a value of a resolved property schema, None when it cannot."""
+    if 'enum' in schema:
+        values = [value for value in schema['enum'] if value is not None]
+        # rng.choice draws bits per call, indexing by random() is several times faster
+        return (lambda rng, i: values[int(rng.random() * len(values))]) if values else None
+    for key in ('oneOf', 'anyOf'):
+        if key in schema:
+            for option in schema[key]:
+                generate = value_generator(name, option)
+                if generate:
+                    return generate
+            return None
+    types = schema.get('type')
+    types = [t for t in (types if isinstance(types, list) else [types]) if t not in (None, 'null')]
+    if not types:
+        return None
+    type = types[0]
+    if type == 'string':
+        if 'pattern' in schema:
+            generate = pattern_generator(schema['pattern'])
+            return (lambda rng, i: generate(rng)) if generate else None
+        if schema.get('format') == 'date-time':
+            return lambda rng, i: time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(rng.randrange(10 ** 9, 2 * 10 ** 9)))
+        return lambda rng, i: f"{name}-{i}"
+    if type == 'integer':
+        low, high = schema.get('minimum', 0), schema.get('maximum', 10000)
+        low, span = int(low), int(high) - int(low) + 1
+        return lambda rng, i: low + int(rng.random() * span)
+    if type == 'number':
+        low, high = schema.get('minimum', 0), schema.get('maximum', 10000)
+        return lambda rng, i: round(rng.uniform(low, high), 2)
+    if type == 'boolean':
+        return lambda rng, i: rng.random() < 0.5
+    if type == 'array':
+        item = value_generator(name, schema.get('items', {}))
+        if not item:
+            return None
+        return lambda rng, i: [item(rng, i) for _ in range(rng.randint(1, MAX_ITEMS))]
+    return None
+
+
+class Simulator:
+    """Generates the records of the types of a dictionary."""
+
+    def __init__(self, documents, program, project, max_samples=DEFAULT_MAX_SAMPLES, seed=DEFAULT_SEED,
+                 required_only=False):
+        """documents as in schema/<program>.json, max_samples records of every type but program and project."""
+        self.dictionary = ResolvedDictionary(documents)
+        self.ids = {self.dictionary.documents[name]['id']: name for name in self.dictionary.nodes()}
+        self.program = program
+        self.project = project
+        self.seed = seed
+        self.required_only = required_only
+        # program.json is written whether or not the project links to it
+        self.order = import_order(compile_plan(documents), simulated_types(self.dictionary) | {'program'})
+        self.counts = {type: 1 if type in ('program', 'project') else max_samples for type in self.order}
+
+    def properties(self, type):
+        """[(name, generator)] of the properties to fill in, in schema order."""
+        schema = self.dictionary.schema(self.ids[type])
+        required = set(schema.get('required', []))
+        skipped = SKIPPED | set(schema.get('systemProperties', [])) | {link['name'] for link in links_of(schema)}
+        properties = []
+        for name, property in schema.get('properties', {}).items():
+            if name in skipped or (self.required_only and name not in required):
+                continue
+            generate = value_generator(name, property)
+            if generate:
+                properties.append((name, generate))
+        return properties
+
+    def links(self, type):
+        """[[(name, target_type, multiplicity)]] of the type, one list per choice: a link or an exclusive subgroup.
+
+        Only links to types generated earlier in the order are kept, self links are left out.
+        """
+        position = self.order.index(type)
+        earlier = set(self.order[:position])
+        choices = []
+        for link in self.dictionary.documents[self.ids[type]].get('links', []):
+            members = link['subgroup'] if 'subgroup' in link else [link]
+            members = [member for member in links_of({'links': members}) if member['target_type'] in earlier]
+            if link.get('exclusive'):
+                # a required member of an exclusive subgroup is the only valid choice
+                members = [member for member in members if member.get('required')] or members
+            members = [(member['name'], member['target_type'], member.get('multiplicity')) for member in members]
+            if not members:
+                continue
+            if link.get('exclusive'):
+                choices.append(members)
+            else:
+                choices.extend([member] for member in members)
+        return choices
+
+    def reference(self, target_type, j):
+        """Link value pointing at the j-th record of target_type."""
+        if target_type == 'program':
+            return {'submitter_id': self.program}
+        if target_type == 'project':
+            return {'code': self.project}
+        return {'submitter_id': submitter_id(self.project, target_type, j)}
+
+    def link_value(self, target_type, multiplicity, rng, i, count):
+        """Link value of the i-th of count records to target_type."""
+        targets = self.counts[target_type]
+        if multiplicity == 'one_to_one':
+            return self.reference(target_type, i % targets)
+        if multiplicity == 'one_to_many':
+            # every target has a single source
+            return [self.reference(target_type, j) for j in range(i % targets, targets, count)][:MAX_ITEMS] \
+                or [self.reference(target_type, i % targets)]
+        if multiplicity == 'many_to_many':
+            return [self.reference(target_type, j)
+                    for j in rng.sample(range(targets), rng.randint(1, min(MAX_ITEMS, targets)))]
+        return self.reference(target_type, int(rng.random() * targets))
+
+    def records(self, type):
+        """Yields the records of a type."""
+        if type == 'program':
+            yield {'name': self.program, 'dbgap_accession_number': self.program, 'submitter_id': self.program,
+                   'type': 'program'}
+            return
+        if type == 'project':
+            yield {'type': 'project', 'code': self.project, 'name': self.project,
+                   'dbgap_accession_number': self.project, 'programs': {'submitter_id': self.program}}
+            return
+        rng = random.Random(f"{self.seed}-{self.program}-{self.project}-{type}")
+        properties = self.properties(type)
+        choices = self.links(type)
+        count = self.counts[type]
+        for i in range(count):
+            record = {'type': type, 'submitter_id': submitter_id(self.project, type, i)}
+            for name, generate in properties:
+                record[name] = generate(rng, i)
+            for members in choices:
+                name, target_type, multiplicity = members[rng.randrange(len(members))] if len(members) > 1 \
+                    else members[0]
+                record[name] = self.link_value(target_type, multiplicity, rng, i, count)
+            yield record
+
+
+def write_records(path, records, compresslevel=DEFAULT_COMPRESSLEVEL):
+    """Writes records as ndjson, gzip compressed unless compresslevel is 0, returns BufferedWriter.rates()."""
+    fileobj = open(path, 'wb')
+    if compresslevel:
+        fileobj = ParallelGzipWriter(fileobj, compresslevel=compresslevel, block_size=DEFAULT_BLOCK_SIZE,
+                                     threads=GZIP_THREADS)
+    with BufferedWriter(fileobj) as writer:
+        for record in records:
+            writer.write(dumpb(record), b'\n')
+    return writer.rates()
+
+
+_simulator = None
+
+
+def _init_worker(documents, program, project, max_samples, seed, required_only):
+    global _simulator
+    _simulator = Simulator(documents, program, project, max_samples, seed, required_only)
+
+
+def simulate_type(type, directory, compresslevel=DEFAULT_COMPRESSLEVEL):
+    """Writes directory/<type>.json, returns (type, BufferedWriter.rates())."""
+    return type, write_records(os.path.join(directory, f"{type}.json"), _simulator.records(type), compresslevel)
+
+
+@click.command()
+@click.option('--program', required=True, help='dictionary to simulate, reads schema/<program>.json')
+@click.option('--project', default=DEFAULT_PROJECT, help='project to simulate')
+@click.option('--path', default=DEFAULT_PATH, help='write <path>/<program>/<project>')
+@click.option('--schema', 'schema_path', default=None, help='compiled dictionary, default schema/<program>.json')
+@click.option('--max_samples', default=DEFAULT_MAX_SAMPLES, help='records of every type')
+@click.option('--seed', default=DEFAULT_SEED, help='same seed, same records')
+@click.option('--required_only', is_flag=True, help='only fill in required properties')
+@click.option('--compresslevel', default=DEFAULT_COMPRESSLEVEL, type=click.IntRange(0, 9),
+              help='gzip the type files, the importer detects gzip by its magic number')
+@click.option('--workers', default=None, type=int, help='generate types in this many processes, default cpu count')
+def simulate(program, project, path, schema_path, max_samples, seed, required_only, compresslevel, workers):
+    """Writes <type>.json ndjson files, program.json and DataImportOrder.txt ready for the importer."""
+    start = time.perf_counter()
+    with open(schema_path or os.path.join('schema', f"{program}.json"), 'rb') as fp:
+        documents = loads(fp.read())
+    simulator = Simulator(documents, program, project, max_samples, seed, required_only)
+    directory = os.path.join(path, program, project)
+    ensure_directory(directory)
+    with open(os.path.join(directory, 'DataImportOrder.txt'), 'w') as fp:
+        fp.write('\n'.join(simulator.order) + '\n')
+    rows = size = 0
+    initargs = (documents, program, project, max_samples, seed, required_only)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+        # largest types first, keeps every worker busy until the end
+        types = sorted(simulator.order, key=lambda type: -simulator.counts[type])
+        futures = [executor.submit(simulate_type, type, directory, compresslevel) for type in types]
+        for future in futures:
+            type, rates = future.result()
+            rows += rates['rows']
+            size += rates['bytes']
+    seconds = time.perf_counter() - start
+    print(f"INFO {directory}: {len(simulator.order)} types, {rows:,} records, {size:,} bytes in {seconds:.1f}s"
+          f" ({int(rows / max(seconds, 1e-9)):,}/sec)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    simulate()
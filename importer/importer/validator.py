@@ -0,0 +1,273 @@
+"""Validates a dictionary's examples/valid and examples/invalid files, as dictionaryutils' tests do, and the
+records of a submission ahead of the importer's transform, in parallel.
+
+Every $ref is resolved once (see importer.dictionary) and one validator is compiled per node type and
+process: generated python code with fastjsonschema when installed, a jsonschema Draft4Validator otherwise.
+"""
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from importer.dictionary import ResolvedDictionary, links_of
+from importer.ioutils import GZIP_MAGIC, loads, reader
+
+try:
+    import fastjsonschema
+except ImportError:  # pragma: no cover
+    fastjsonschema = None
+try:
+    import jsonschema
+except ImportError:  # pragma: no cover
+    jsonschema = None
+
+# 'fastjsonschema' when installed, override with IMPORTER_VALIDATOR=jsonschema
+VALIDATOR = os.environ.get('IMPORTER_VALIDATOR', 'fastjsonschema' if fastjsonschema else 'jsonschema')
+# bytes of ndjson validated per batch
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+
+
+def examples_dir(dictionary_dir, program):
+    """Directory of a dictionary's example files."""
+    return os.path.join(dictionary_dir, program, 'gdcdictionary', 'examples')
+
+
+class Validators:
+    """Compiled validators of the node types of a dictionary."""
+
+    def __init__(self, documents):
+        """documents as in schema/<program>.json."""
+        assert VALIDATOR != 'jsonschema' or jsonschema, "validation requires jsonschema or fastjsonschema"
+        self.dictionary = ResolvedDictionary(documents)
+        self.types = {self.dictionary.documents[name]['id']: name for name in self.dictionary.nodes()}
+        self._validators = {}
+
+    def schema(self, type):
+        """Schema of a type, system properties with a default accept anything and are not required.
+
+        The submission service sets them, so a record is valid as is, without its defaults merged in.
+        """
+        schema = self.dictionary.schema(self.types[type])
+        relaxed = {key for key in schema.get('systemProperties', []) if 'default' in schema['properties'].get(key, {})}
+        if not relaxed:
+            return schema
+        schema = dict(schema, properties={key: {} if key in relaxed else value
+                                          for key, value in schema['properties'].items()})
+        if 'required' in schema:
+            schema['required'] = [key for key in schema['required'] if key not in relaxed]
+        return schema
+
+    def validator(self, type):
+        """Compiled validator of a type, returns the (path, message) errors of an entity."""
+        if type not in self._validators:
+            schema = self.schema(type)
+            if VALIDATOR == 'fastjsonschema':
+                # like jsonschema without a format checker: formats are annotations, defaults are not filled in
+                validate = fastjsonschema.compile(schema, use_default=False, use_formats=False)
+
+                def errors(entity, validate=validate):
+                    try:
+                        validate(entity)
+                    except fastjsonschema.JsonSchemaException as e:
+                        # path starts with 'data', the entity itself; fastjsonschema stops at the first error
+                        return [('/'.join(map(str, (e.path or [])[1:])), e.message)]
+                    return []
+            else:
+                validator = jsonschema.Draft4Validator(schema)
+
+                def errors(entity, validator=validator):
+                    return [('/'.join(map(str, e.absolute_path)), e.message) for e in validator.iter_errors(entity)]
+            self._validators[type] = errors
+        return self._validators[type]
+
+    def errors(self, entity):
+        """(path, message) errors of one entity, [] when valid; entity is not modified."""
+        if not isinstance(entity, dict) or entity.get('type') not in self.types:
+            return [('', f"unknown type {entity.get('type') if isinstance(entity, dict) else entity}")]
+        return self.validator(entity['type'])(entity)
+
+    def validate(self, entity):
+        """Error messages of one entity, [] when valid."""
+        return [message for _, message in self.errors(entity)]
+
+
+_validators = None
+
+
+def _init_worker(documents):
+    global _validators
+    _validators = Validators(documents)
+
+
+def validate_file(job):
+    """Validates the entities of one example file, returns (path, expected valid, errors of every entity)."""
+    path, valid = job
+    with open(path, 'r') as fp:
+        try:
+            document = json.load(fp)
+        except ValueError as e:
+            return path, valid, [[f"invalid json: {e}"]]
+    entities = document if isinstance(document, list) else [document]
+    return path, valid, [_validators.validate(entity) for entity in entities]
+
+
+def validate_examples(documents, directory, workers=None):
+    """Validates directory/valid/*.json and directory/invalid/*.json in a process pool.
+
+    Returns ([(path, failure)], number of files); a valid file fails when an entity has errors, an invalid
+    one when an entity has none.
+    """
+    jobs = [(path, True) for path in sorted(glob.glob(os.path.join(directory, 'valid', '*.json')))]
+    jobs += [(path, False) for path in sorted(glob.glob(os.path.join(directory, 'invalid', '*.json')))]
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(documents,)) as executor:
+        chunksize = max(1, len(jobs) // (4 * (workers or os.cpu_count())))
+        for path, valid, errors in executor.map(validate_file, jobs, chunksize=chunksize):
+            for i, entity_errors in enumerate(errors):
+                if valid and entity_errors:
+                    failures.append((path, f"entity {i}: {entity_errors[0]}"))
+                elif not valid and not entity_errors:
+                    failures.append((path, f"entity {i}: expected to be invalid"))
+    return failures, len(jobs)
+
+
+def batches(path, batch_bytes=DEFAULT_BATCH_BYTES):
+    """(offset, length) ranges of whole lines of a plain ndjson file, [(0, None)], the whole file, otherwise."""
+    with open(path, 'rb') as fp:
+        head = fp.read(len(GZIP_MAGIC))
+        fp.seek(0)
+        first = fp.readline().strip() if head != GZIP_MAGIC and head.lstrip()[:1] == b'{' else b''
+        try:
+            ndjson = isinstance(loads(first), dict)
+        except ValueError:
+            ndjson = False
+        if not ndjson:
+            return [(0, None)]
+        size = os.path.getsize(path)
+        ranges = []
+        offset = 0
+        while offset < size:
+            fp.seek(min(offset + batch_bytes, size))
+            fp.readline()
+            end = min(fp.tell(), size)
+            ranges.append((offset, end - offset))
+            offset = end
+        return ranges
+
+
+def validate_batch(job):
+    """Validates a range of a type file, returns (records, [reject]); project_id is set as the importer sets it."""
+    path, offset, length, project_id = job
+    if length is None:
+        records = reader(path)
+    else:
+        with open(path, 'rb') as fp:
+            fp.seek(offset)
+            lines = fp.read(length).splitlines()
+        records = (loads(line) for line in lines if line.strip())
+    count = 0
+    rejects = []
+    for record in records:
+        count += 1
+        key = record.get('submitter_id', record.get('code'))
+        if record.get('type') == 'program':
+            # the importer keys the program by submitter_id, the schema has no such property
+            record.pop('submitter_id', None)
+        elif 'project_id' not in record and record.get('type') != 'project':
+            record['project_id'] = project_id
+        errors = _validators.errors(record)
+        if errors:
+            rejects.append({
+                'submitter_id': key,
+                'errors': [{'path': error_path, 'message': message} for error_path, message in errors],
+            })
+    return count, rejects
+
+
+def dependent_rejects(path, dependencies, rejected):
+    """Rejects of the records of a type file linking to rejected records, dependencies is [(property, target, ids)]."""
+    for record in reader(path):
+        key = record.get('submitter_id', record.get('code'))
+        if key in rejected:
+            continue
+        errors = []
+        for property, target, ids in dependencies:
+            references = record.get(property) or []
+            for reference in references if isinstance(references, list) else [references]:
+                target_key = reference.get('submitter_id', reference.get('code')) if isinstance(reference, dict) else None
+                if target_key in ids:
+                    errors.append({'path': property, 'message': f"links to rejected {target} {target_key}"})
+        if errors:
+            yield {'submitter_id': key, 'errors': errors}
+
+
+class RecordValidation:
+    """Validates the type files of a project in batches on a process pool, while earlier types are transformed.
+
+    rejected(type) waits for the batches of a type and appends its rejects to rejects_path, one json line
+    per record with the path and message of each error. Records linking to a rejected record are rejected
+    too, they would dangle. workers=0 validates in process, on demand.
+    """
+
+    def __init__(self, documents, directory, project_id, rejects_path, workers=None, metrics=None,
+                 batch_bytes=DEFAULT_BATCH_BYTES):
+        """Start the pool, truncate the rejects file."""
+        self.directory = directory
+        self.project_id = project_id
+        self.rejects_path = rejects_path
+        self.metrics = metrics
+        self.batch_bytes = batch_bytes
+        # type -> [(link property, target type)]
+        self.links = {document['id']: [(link['name'], link['target_type']) for link in links_of(document)]
+                      for name, document in documents.items()
+                      if not name.startswith('_') and isinstance(document, dict) and 'id' in document}
+        if workers == 0:
+            _init_worker(documents)
+            self.executor = None
+        else:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(documents,))
+        self.jobs = {}
+        # type -> rejected submitter_ids, for the records linking to them
+        self.rejected_ids = {}
+        self.records = 0
+        self.rejects = 0
+        open(rejects_path, 'w').close()
+
+    def submit(self, names):
+        """Queue the batches of types, in the order they will be asked for."""
+        for name in names:
+            path = os.path.join(self.directory, f"{name}.json")
+            jobs = [(path, offset, length, self.project_id) for offset, length in batches(path, self.batch_bytes)]
+            self.jobs[name] = [self.executor.submit(validate_batch, job) for job in jobs] if self.executor else jobs
+
+    def rejected(self, name):
+        """submitter_ids (codes for project) of the records of a type that failed validation, call in import order."""
+        start = time.perf_counter()
+        rejected = set()
+        count = 0
+        with open(self.rejects_path, 'a') as fp:
+            for job in self.jobs.pop(name):
+                batch_count, rejects = job.result() if self.executor else validate_batch(job)
+                count += batch_count
+                for reject in rejects:
+                    rejected.add(reject['submitter_id'])
+                    fp.write(json.dumps(dict(reject, type=name)) + '\n')
+            # only read again when a linked type has rejects
+            dependencies = [(property, target, self.rejected_ids[target])
+                            for property, target in self.links.get(name, []) if self.rejected_ids.get(target)]
+            if dependencies:
+                for reject in dependent_rejects(os.path.join(self.directory, f"{name}.json"), dependencies, rejected):
+                    rejected.add(reject['submitter_id'])
+                    fp.write(json.dumps(dict(reject, type=name)) + '\n')
+        self.rejected_ids[name] = rejected
+        self.records += count
+        self.rejects += len(rejected)
+        if self.metrics:
+            self.metrics.add('validate', name, count, 0, time.perf_counter() - start)
+        return rejected
+
+    def close(self):
+        """Stop the pool."""
+        if self.executor:
+            self.executor.shutdown()
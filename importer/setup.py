@@ -24,8 +24,23 @@ setup(
         "gen3>=4.2.0",
         "indexclient>=2.1",
         "dictionaryutils>=3.4.1",
+        "PyYAML>=5.1",
     ],
     extras_require={
+        "fast": [
+            "orjson>=3.5",
+        ],
+        "postgres": [
+            "psycopg2-binary>=2.8",
+        ],
+        "watch": [
+            "inotify_simple>=1.3",
+            "jsonschema>=3.2",
+        ],
+        "validate": [
+            "fastjsonschema>=2.19",
+            "jsonschema>=3.2",
+        ],
         "test": [
             "pytest",
         ],
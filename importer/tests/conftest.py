@@ -0,0 +1,146 @@
+"""Fixtures shared by the importer tests: a tiny dictionary, its submissions and a disposable postgres.
+
+Postgres tests use IMPORTER_TEST_DSN when set (its public schema is dropped), otherwise a postgres
+container started with docker, and are skipped when neither is available.
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import time
+import uuid
+
+import pytest
+
+from importer.plan import compile_plan
+
+PROGRAM = 'test'
+PROJECT = 'p1'
+POSTGRES_IMAGE = os.environ.get('IMPORTER_TEST_POSTGRES_IMAGE', 'postgres:13')
+# seconds to wait for the container to accept connections
+POSTGRES_TIMEOUT = 60
+
+SCHEMA = {
+    'program.yaml': {'id': 'program', 'required': ['name'], 'links': [], 'properties': {
+        'type': {'type': 'string'}, 'name': {'type': 'string'}, 'dbgap_accession_number': {'type': 'string'}}},
+    'project.yaml': {'id': 'project', 'required': ['code'], 'links': [
+        {'name': 'programs', 'label': 'member_of', 'target_type': 'program'}], 'properties': {
+        'type': {'type': 'string'}, 'code': {'type': 'string'}}},
+    'case.yaml': {'id': 'case', 'required': ['submitter_id'], 'links': [
+        {'name': 'projects', 'label': 'member_of', 'target_type': 'project'}], 'properties': {
+        'type': {'type': 'string'}, 'submitter_id': {'type': 'string'}, 'disease_type': {'type': 'string'}}},
+    'sample.yaml': {'id': 'sample', 'required': ['submitter_id'], 'links': [
+        {'name': 'cases', 'label': 'derived_from', 'target_type': 'case'}], 'properties': {
+        'type': {'type': 'string'}, 'submitter_id': {'type': 'string'}, 'composition': {'type': 'string'}}},
+}
+
+
+def build_records(cases=2, samples_per_case=2):
+    """A submission of the tiny dictionary, {type: [records]}."""
+    submission = {
+        'program': [{'type': 'program', 'name': PROGRAM, 'submitter_id': PROGRAM}],
+        'project': [{'type': 'project', 'code': PROJECT, 'programs': {'name': PROGRAM}}],
+        'case': [],
+        'sample': [],
+    }
+    for i in range(cases):
+        submission['case'].append({'type': 'case', 'submitter_id': f'case-{i}', 'disease_type': 'Melanoma',
+                                   'projects': {'code': PROJECT}})
+        for j in range(samples_per_case):
+            submission['sample'].append({'type': 'sample', 'submitter_id': f'sample-{i}-{j}', 'composition': 'Blood',
+                                         'cases': {'submitter_id': f'case-{i}'}})
+    return submission
+
+
+@pytest.fixture
+def records():
+    """build_records, to change a submission before writing it."""
+    return build_records
+
+
+@pytest.fixture
+def submission(tmp_path, monkeypatch):
+    """Runs the test in a scratch directory holding schema/test.json, call it to write data/test/p1/*.json."""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('schema')
+    with open(f'schema/{PROGRAM}.json', 'w') as fp:
+        json.dump(SCHEMA, fp)
+
+    def write(types=None):
+        directory = f'data/{PROGRAM}/{PROJECT}'
+        os.makedirs(directory, exist_ok=True)
+        for name, items in (build_records() if types is None else types).items():
+            with open(f'{directory}/{name}.json', 'w') as fp:
+                json.dump(items, fp)
+        return 'data'
+
+    return write
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _connect(psycopg2, dsn, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return psycopg2.connect(dsn)
+        except psycopg2.OperationalError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+@pytest.fixture(scope='session')
+def postgres():
+    """dsn of a postgres server for the session."""
+    psycopg2 = pytest.importorskip('psycopg2')
+    if os.environ.get('IMPORTER_TEST_DSN'):
+        yield os.environ['IMPORTER_TEST_DSN']
+        return
+    docker = shutil.which('docker')
+    if not docker:
+        pytest.skip('set IMPORTER_TEST_DSN or install docker to run the postgres tests')
+    port = _free_port()
+    name = f'importer-test-{uuid.uuid4().hex[:8]}'
+    started = subprocess.run([docker, 'run', '-d', '--rm', '--name', name, '-e', 'POSTGRES_PASSWORD=test',
+                              '-p', f'127.0.0.1:{port}:5432', POSTGRES_IMAGE], capture_output=True)
+    if started.returncode:
+        pytest.skip(f'cannot start {POSTGRES_IMAGE}: {started.stderr.decode().strip()}')
+    try:
+        dsn = f'host=127.0.0.1 port={port} dbname=postgres user=postgres password=test'
+        _connect(psycopg2, dsn, POSTGRES_TIMEOUT).close()
+        yield dsn
+    finally:
+        subprocess.run([docker, 'rm', '-f', name], capture_output=True)
+
+
+@pytest.fixture
+def database(postgres, submission):
+    """dsn of an empty database holding the tiny dictionary's tables, edges reference their nodes."""
+    import psycopg2
+    connection = psycopg2.connect(postgres)
+    connection.autocommit = True
+    plan = compile_plan(SCHEMA)
+    with connection.cursor() as cursor:
+        cursor.execute('drop schema public cascade ; create schema public')
+        cursor.execute('create table transaction_logs(id serial primary key, submitter text, role text,'
+                       ' program text, project text, is_dry_run bool, state text, closed bool,'
+                       ' created_datetime timestamptz, canonical_json jsonb)')
+        for tables in plan.values():
+            cursor.execute(f"create table {tables['node_table']}(created timestamptz default now(), acl text[],"
+                           " _sysan jsonb, _props jsonb, node_id text primary key)")
+        for name, tables in plan.items():
+            for link in tables['links']:
+                target = plan[link['target_type']]['node_table']
+                cursor.execute(
+                    f"create table {link['edge_table']}(created timestamptz default now(), acl text[], _sysan jsonb,"
+                    f" _props jsonb, src_id text references {tables['node_table']}(node_id) on delete cascade,"
+                    f" dst_id text references {target}(node_id) on delete cascade, primary key (src_id, dst_id))")
+    connection.close()
+    return postgres
+
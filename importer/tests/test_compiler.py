@@ -0,0 +1,80 @@
+"""Dictionary compiler and its watch mode."""
+import json
+import os
+
+import pytest
+import yaml
+
+from importer import compiler
+from importer.compiler import Compiler
+
+CASE = """\
+$schema: "http://json-schema.org/draft-04/schema#"
+id: case
+title: Case
+type: object
+category: administrative
+links: []
+required: [submitter_id]
+properties:
+  submitter_id:
+    type: string
+"""
+BROKEN = CASE + "  disease_type: [string\n"
+
+
+@pytest.fixture
+def dictionary(tmp_path, monkeypatch):
+    """Runs the test in a scratch directory holding dictionary/test, returns its schemas directory."""
+    monkeypatch.chdir(tmp_path)
+    directory = compiler.schemas_dir('dictionary', 'test')
+    os.makedirs(directory)
+    os.makedirs('schema')
+    write(directory, '_settings.yaml', 'enable_relationship_based_access: false\n')
+    write(directory, 'case.yaml', CASE)
+    return directory
+
+
+def write(directory, name, content):
+    with open(os.path.join(directory, name), 'w') as fp:
+        fp.write(content)
+
+
+def test_compile_only_changed_files(dictionary):
+    assert sorted(Compiler('test', versions={'_dict_version': 'v1'}).compile()) == ['_settings.yaml', 'case.yaml']
+    assert Compiler('test').compile() == []
+    with open('schema/test.json') as fp:
+        documents = json.load(fp)
+    assert documents['case.yaml']['id'] == 'case'
+    assert documents['_settings.yaml']['_dict_version'] == 'v1'
+
+
+def test_yaml_error_names_the_file(dictionary):
+    Compiler('test').compile()
+    write(dictionary, 'case.yaml', BROKEN)
+    broken = Compiler('test')
+    with pytest.raises(yaml.YAMLError, match=r'in ".*case\.yaml", line 11'):
+        broken.compile()
+    assert broken.broken == 'case.yaml'
+    # output and cache are left as they were
+    with open('schema/test.json') as fp:
+        assert 'disease_type' not in fp.read()
+
+
+def test_watch_logs_the_error_and_the_fix(dictionary, monkeypatch, capsys):
+    def changes(directory, interval):
+        write(directory, 'case.yaml', BROKEN)
+        yield
+        # reverted, the content matches the cache again
+        write(directory, 'case.yaml', CASE)
+        yield
+        write(directory, 'case.yaml', CASE + "  disease_type:\n    type: string\n")
+        yield
+
+    monkeypatch.setattr(compiler, 'watch_changes', changes)
+    compiler.watch.callback('test', 'dictionary', 'schema', compiler.DEFAULT_POLL_INTERVAL)
+    lines = capsys.readouterr().err.splitlines()
+    assert any(line.startswith('ERROR while parsing') for line in lines)
+    assert any('case.yaml", line 11' in line for line in lines)
+    assert 'INFO case.yaml parses again' in lines
+    assert any(line.startswith('INFO compiled case.yaml') for line in lines)
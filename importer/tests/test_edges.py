@@ -0,0 +1,72 @@
+"""Edge deduplication and the external merge sort."""
+import io
+import random
+import uuid
+
+import pytest
+
+from importer import edges
+from importer.edges import EdgeWriter, pair_row
+
+
+class Handle(io.StringIO):
+    """Text handle keeping its rows once closed."""
+
+    def close(self):
+        self.rows = self.getvalue().splitlines(keepends=True)
+        super().close()
+
+
+def edge_pairs(count, seed=0):
+    """count random (src, dst) uuid pairs, some listed several times, in random order."""
+    rng = random.Random(seed)
+    ids = [uuid.UUID(int=rng.getrandbits(128)) for _ in range(count // 4 + 1)]
+    pairs = [(rng.choice(ids), rng.choice(ids)) for _ in range(count)]
+    return pairs + rng.sample(pairs, count // 3)
+
+
+def expected_rows(pairs):
+    ordered = sorted(set(pairs), key=lambda pair: (str(pair[0]), str(pair[1])))
+    return [f'{src}\t{dst}\t{{}}\t{{}}\t{{}}\n' for src, dst in ordered]
+
+
+def test_pair_row():
+    src, dst = uuid.uuid4(), uuid.uuid4()
+    assert pair_row(src.int << 128 | dst.int) == f'{src}\t{dst}\t{{}}\t{{}}\t{{}}\n'
+
+
+def test_unsorted_rows_are_written_once_in_arrival_order():
+    pairs = edge_pairs(500)
+    handle = Handle()
+    writer = EdgeWriter(handle)
+    for src, dst in pairs:
+        writer.write_edge(src, dst)
+    writer.close()
+    unique = list(dict.fromkeys(pairs))
+    assert handle.rows == [f'{src}\t{dst}\t{{}}\t{{}}\t{{}}\n' for src, dst in unique]
+    assert writer.duplicates == len(pairs) - len(unique)
+
+
+@pytest.mark.parametrize('pairs_in_memory', [1, 7, 64, 100000])
+def test_sorted_rows_dedup_across_spilled_runs(monkeypatch, pairs_in_memory):
+    # 1 MiB of memory per pair, --edge_memory counts pairs
+    monkeypatch.setattr(edges, 'PAIR_BYTES', 1024 * 1024)
+    pairs = edge_pairs(2000)
+    handle = Handle()
+    writer = EdgeWriter(handle, sort=True, memory=pairs_in_memory)
+    for src, dst in pairs:
+        writer.write_edge(src, dst)
+    spilled = len(writer.runs)
+    writer.close()
+    if pairs_in_memory < 2000:
+        assert spilled > 1
+    assert handle.rows == expected_rows(pairs)
+    assert writer.duplicates == len(pairs) - len(set(pairs))
+    assert writer.runs == []
+
+
+def test_sorted_empty_table():
+    handle = Handle()
+    writer = EdgeWriter(handle, sort=True)
+    writer.close()
+    assert handle.rows == []
@@ -0,0 +1,186 @@
+"""Import planning: incremental selection, reference checks, piped inputs."""
+import json
+import os
+import threading
+
+import pytest
+
+from importer.importer import check_references, import_single, read_imports, save_manifest, select_imports
+from importer.metrics import Metrics
+from importer.plan import load_plan
+
+
+def plan_and_imports():
+    plan, digest = load_plan('schema/test.json', 'output/.plans')
+    return plan, digest, read_imports('data', 'test', 'p1', plan)
+
+
+def select(digest=None):
+    """Types to reload and the manifest, saved as a completed import would."""
+    plan, schema_digest, imports = plan_and_imports()
+    changed, manifest = select_imports('data', 'test', 'p1', imports, plan, digest or schema_digest, 'output')
+    os.makedirs('output/test/p1', exist_ok=True)
+    save_manifest('output', 'test', 'p1', manifest)
+    return changed
+
+
+def test_first_incremental_import_loads_everything(submission):
+    submission()
+    assert select() == ['program', 'project', 'case', 'sample']
+
+
+def test_unchanged_inputs_are_skipped(submission):
+    submission()
+    select()
+    assert select() == []
+
+
+def test_changed_type_cascades_to_types_linking_to_it(submission, records):
+    submission()
+    select()
+    submission_records = records()
+    submission_records['case'][0]['disease_type'] = 'Glioma'
+    submission({'case': submission_records['case']})
+    # samples link to cases, their edges are reloaded with them
+    assert select() == ['case', 'sample']
+    assert select() == []
+
+
+def test_changed_leaf_does_not_cascade(submission, records):
+    submission()
+    select()
+    submission_records = records()
+    submission_records['sample'][0]['composition'] = 'Tissue'
+    submission({'sample': submission_records['sample']})
+    assert select() == ['sample']
+
+
+def test_changed_root_reloads_every_dependent(submission, records):
+    submission()
+    select()
+    submission_records = records()
+    submission_records['program'][0]['dbgap_accession_number'] = 'phs000001'
+    submission({'program': submission_records['program']})
+    assert select() == ['program', 'project', 'case', 'sample']
+
+
+def test_changed_schema_reloads_everything(submission):
+    submission()
+    select()
+    assert select(digest='another schema') == ['program', 'project', 'case', 'sample']
+
+
+def test_pending_manifest_is_not_used(submission):
+    submission()
+    plan, digest, imports = plan_and_imports()
+    _, manifest = select_imports('data', 'test', 'p1', imports, plan, digest, 'output')
+    os.makedirs('output/test/p1', exist_ok=True)
+    # the script failed before promoting it
+    save_manifest('output', 'test', 'p1', manifest, pending=True)
+    assert select() == ['program', 'project', 'case', 'sample']
+
+
+def check(imports=None):
+    plan, _, derived = plan_and_imports()
+    return check_references('data', 'test', 'p1', plan, imports or derived)
+
+
+def test_every_reference_resolves(submission):
+    submission()
+    assert check() == {}
+
+
+def test_typo_in_a_reference(submission, records):
+    submission_records = records()
+    submission_records['sample'][1]['cases'] = {'submitter_id': 'csae-0'}
+    submission(submission_records)
+    assert check() == {('sample', 'cases', 'case'): [1, ['csae-0']]}
+
+
+def test_missing_submitter_id_and_type(submission, records):
+    submission_records = records()
+    del submission_records['case'][1]['submitter_id']
+    del submission_records['sample'][0]['type']
+    submission(submission_records)
+    dangling = check()
+    assert dangling[('case', 'submitter_id', None)] == [1, ['record 2']]
+    assert dangling[('sample', 'type', None)] == [1, ['record 1']]
+    # case-1 is not indexed, the samples derived from it dangle
+    assert dangling[('sample', 'cases', 'case')] == [2, ['case-1', 'case-1']]
+
+
+def test_broken_link_cascades_no_further_than_the_missing_record(submission, records):
+    submission_records = records()
+    # case-0 is dropped: its samples dangle, the rest of the chain resolves
+    del submission_records['case'][0]
+    submission(submission_records)
+    assert check() == {('sample', 'cases', 'case'): [2, ['case-0', 'case-0']]}
+
+
+def test_references_to_types_read_later_are_checked(submission, records):
+    submission_records = records()
+    submission_records['sample'][0]['cases'] = {'submitter_id': 'case-9'}
+    submission(submission_records)
+    # a misordered DataImportOrder.txt, samples are read before their cases
+    assert check(['program', 'project', 'sample', 'case']) == {('sample', 'cases', 'case'): [1, ['case-9']]}
+
+
+def test_program_reference_is_the_program_name(submission, records):
+    submission_records = records()
+    del submission_records['program']
+    submission(submission_records)
+    assert check(['project', 'case', 'sample']) == {}
+
+
+def pipe(name, records=None):
+    """Replaces data/test/p1/<name>.json with a named pipe, fed records on a thread when given."""
+    path = f'data/test/p1/{name}.json'
+    os.remove(path)
+    os.mkfifo(path)
+    if records is None:
+        return None
+
+    def feed():
+        with open(path, 'w') as fp:
+            json.dump(records, fp)
+
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+    return writer
+
+
+def run(**options):
+    kwargs = dict(path='data', program='test', project='p1', delete_first=True, output_dir='output', workers=1,
+                  loader='script', dsn=None, batch_size=100, incremental=False, metrics=Metrics())
+    kwargs.update(options)
+    os.makedirs('output/test/p1', exist_ok=True)
+    import_single(**kwargs)
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='named pipes')
+def test_piped_input_is_read_once(submission, records, capsys):
+    submission()
+    writer = pipe('case', records()['case'])
+    run()
+    writer.join()
+    with open('output/test/p1/node_case.tsv') as fp:
+        assert len(fp.readlines()) == 2
+    assert 'data/test/p1/case.json' in capsys.readouterr().out
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='named pipes')
+@pytest.mark.parametrize('option', [{'check_refs': True}, {'incremental': True}, {'validate': True}])
+def test_options_reading_ahead_reject_piped_input(submission, option):
+    submission()
+    # nothing feeds it, the import has to stop before opening it
+    pipe('sample')
+    with pytest.raises(AssertionError, match='sample.json ahead of the import, a pipe can only be read once'):
+        run(**option)
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='named pipes')
+def test_workers_reject_piped_project(submission):
+    submission()
+    pipe('project')
+    with pytest.raises(AssertionError, match='--workers reads project.json'):
+        run(workers=2)
@@ -0,0 +1,160 @@
+"""Json streaming and format detection."""
+import gzip
+import io
+import json
+import os
+import random
+import threading
+
+import pytest
+
+from importer import ioutils
+from importer.ioutils import JsonReader, iter_json_array, open_stream, sniff_format
+
+RECORDS = [{'submitter_id': f'case-{i}', 'weight': i / 3, 'tags': ['a', 'b'], 'note': 'comma, ] bracket'}
+           for i in range(50)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 64, 1024 * 1024])
+@pytest.mark.parametrize('text', [
+    json.dumps(RECORDS),
+    json.dumps(RECORDS, indent=2),
+    '[]',
+    ' [ ] \n',
+    '[1, 3.5, -2e3, "x", null, true, [1, [2]], {"a": {}}]',
+])
+def test_iter_json_array_matches_json_loads(text, chunk_size):
+    assert list(iter_json_array(io.StringIO(text), chunk_size)) == json.loads(text)
+
+
+def test_iter_json_array_yields_a_non_array_document():
+    assert list(iter_json_array(io.StringIO('{"a": 1}'))) == [{'a': 1}]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 1024])
+@pytest.mark.parametrize('text', [
+    '',
+    '[',
+    '[{"a": 1},',
+    '[{"a": 1}, {"b":',
+    '[1 2]',
+    '[,,1,,]',
+    '[1,]',
+    '[1] 2',
+    '[1]]',
+])
+def test_iter_json_array_rejects_truncated_and_malformed_input(text, chunk_size):
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_array(io.StringIO(text), chunk_size))
+
+
+@pytest.mark.parametrize('head,expected', [
+    (' [{"a": 1}', 'array'),
+    ('{"a": 1}\n{"a": 2}\n', 'ndjson'),
+    ('{\n  "a": 1\n}', 'object'),
+])
+def test_sniff_format(head, expected):
+    assert sniff_format(head) == expected
+
+
+def ndjson(records):
+    return ''.join(json.dumps(record) + '\n' for record in records)
+
+
+@pytest.mark.parametrize('text', [json.dumps(RECORDS), json.dumps(RECORDS, indent=2), ndjson(RECORDS),
+                                  ndjson(RECORDS).replace('\n', '\n\n')])
+def test_json_reader_formats(tmp_path, text):
+    path = tmp_path / 'case.json'
+    path.write_text(text)
+    assert list(JsonReader(str(path))) == RECORDS
+
+
+def test_json_reader_long_first_line(tmp_path):
+    # the first ndjson record is longer than the sniffed head
+    records = [{'note': 'x' * 10000, 'i': i} for i in range(3)]
+    path = tmp_path / 'case.json'
+    path.write_text(ndjson(records))
+    reader = JsonReader(str(path))
+    assert reader.format == 'ndjson'
+    assert list(reader) == records
+
+
+def test_json_reader_gzip_detected_by_magic(tmp_path):
+    # no .gz suffix, the magic number decides
+    path = tmp_path / 'case.json'
+    path.write_bytes(gzip.compress(json.dumps(RECORDS).encode()))
+    assert list(JsonReader(str(path))) == RECORDS
+
+
+@pytest.mark.parametrize('data', [json.dumps(RECORDS).encode(), gzip.compress(ndjson(RECORDS).encode())])
+def test_json_reader_from_a_pipe(data):
+    read_fd, write_fd = os.pipe()
+
+    def feed():
+        with os.fdopen(write_fd, 'wb') as fp:
+            fp.write(data)
+
+    writer = threading.Thread(target=feed)
+    writer.start()
+    with os.fdopen(read_fd, 'rb', buffering=0) as fp:
+        assert list(JsonReader(fp)) == RECORDS
+    writer.join()
+
+
+def test_open_stream_file_object():
+    assert open_stream(io.BytesIO(gzip.compress('[1]'.encode()))).read() == '[1]'
+
+
+def test_json_reader_truncated_gzip(tmp_path):
+    path = tmp_path / 'case.json'
+    path.write_bytes(gzip.compress(json.dumps(RECORDS).encode())[:-100])
+    with pytest.raises((EOFError, json.JSONDecodeError)):
+        list(JsonReader(str(path)))
+
+
+@pytest.mark.parametrize('obj', [
+    RECORDS,
+    {'weight': float('nan')},
+    [float('inf'), float('-inf')],
+    {'nested': [{'weight': float('nan')}]},
+    1e16,
+    [1e16, 1.5e300, 9999999999999998.0],
+    [1e-4, 9.999e-05, 1e-7, 5e-324],
+    [-0.0, 0.0, 1.0, 2.5],
+    {'note': 'naïve ünïcödé', 'del': '\x7f', 'tab': 'a\tb "q"'},
+    {'emoji': '\U0001f600'},
+    {'md5sum': '1e5d0c4a', 'object_id': '3e8f-9E10'},
+    2 ** 70,
+    {1: 'int key'},
+    None,
+    'x',
+])
+@pytest.mark.parametrize('codec', ['json', 'orjson'])
+def test_dumpb_identical_to_json_dumps(obj, codec, monkeypatch):
+    if codec == 'orjson':
+        pytest.importorskip('orjson')
+    monkeypatch.setattr(ioutils, 'JSON_CODEC', codec)
+    assert ioutils.dumpb(obj) == json.dumps(obj, separators=(',', ':')).encode()
+    assert ioutils.dumps(obj) == json.dumps(obj, separators=(',', ':'))
+    assert ioutils.dumpb(obj, separators=None) == json.dumps(obj).encode()
+
+
+@pytest.mark.parametrize('codec', ['json', 'orjson'])
+def test_loads_accepts_what_json_loads_accepts(codec, monkeypatch):
+    if codec == 'orjson':
+        pytest.importorskip('orjson')
+    monkeypatch.setattr(ioutils, 'JSON_CODEC', codec)
+    text = '{"a": NaN, "b": Infinity, "c": 123456789012345678901234567890, "d": "é"}'
+    decoded = ioutils.loads(text)
+    assert decoded['a'] != decoded['a']
+    assert decoded['b'] == float('inf')
+    assert decoded['c'] == 123456789012345678901234567890
+    assert ioutils.loads(text.encode())['d'] == 'é'
+
+
+def test_dumpb_random_floats_identical(monkeypatch):
+    pytest.importorskip('orjson')
+    monkeypatch.setattr(ioutils, 'JSON_CODEC', 'orjson')
+    rng = random.Random(0)
+    floats = [rng.random() * 10 ** rng.randrange(-8, 20) * rng.choice([1, -1]) for _ in range(20000)]
+    assert [ioutils.dumpb(value) for value in floats] == [json.dumps(value).encode() for value in floats]
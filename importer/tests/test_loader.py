@@ -0,0 +1,179 @@
+"""Copy and diff loaders against a disposable postgres, see conftest.postgres."""
+import pytest
+
+from importer.importer import read_imports, transform
+from importer.loader import CopyWriter, Loader
+from importer.plan import load_plan
+
+
+def load(dsn, diff=False, delete_first=False, batch_size=2, sort_edges=False):
+    """Loads data/test/p1 in one transaction, as import_single streams it, returns the diff stats."""
+    plan, _ = load_plan('schema/test.json', 'output/.plans')
+    loader = Loader(dsn, batch_size, diff=diff)
+    try:
+        with loader.transaction() as sink:
+            for name in read_imports('data', 'test', 'p1', plan):
+                transform(name, 'data', 'test', 'p1', plan, delete_first, sink, sort_edges=sort_edges)
+    finally:
+        loader.close()
+    return loader.stats
+
+
+def query(dsn, statement):
+    """Rows of a statement."""
+    import psycopg2
+    connection = psycopg2.connect(dsn)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(statement)
+            return cursor.fetchall()
+    finally:
+        connection.close()
+
+
+def counts(dsn):
+    """Rows per node and edge table."""
+    tables = [row[0] for row in query(dsn, "select tablename from pg_tables where schemaname = 'public'"
+                                           " and tablename <> 'transaction_logs'")]
+    return {table: query(dsn, f"select count(*) from {table}")[0][0] for table in tables}
+
+
+def props(dsn, table, submitter_id):
+    """_props of a node."""
+    return query(dsn, f"select _props from {table} where _props->>'submitter_id' = '{submitter_id}'")[0][0]
+
+
+def edge_tables():
+    """Edge table per type of the tiny dictionary, each has one link."""
+    plan, _ = load_plan('schema/test.json', 'output/.plans')
+    return {name: tables['links'][0]['edge_table'] for name, tables in plan.items() if tables['links']}
+
+
+def expected_counts(cases, samples):
+    edges = edge_tables()
+    return {
+        'node_program': 1, 'node_project': 1, 'node_case': cases, 'node_sample': samples,
+        edges['project']: 1, edges['case']: cases, edges['sample']: samples,
+    }
+
+
+def test_copy_into_empty_tables(database, submission):
+    submission()
+    load(database)
+    assert counts(database) == expected_counts(2, 4)
+    assert props(database, 'node_sample', 'sample-1-0')['project_id'] == 'test-p1'
+
+
+def test_copy_rerun(database, submission):
+    submission()
+    load(database, delete_first=True)
+    load(database, delete_first=True)
+    # the shared program node is kept, the project's rows are replaced
+    assert counts(database) == expected_counts(2, 4)
+
+
+def test_diff_unchanged(database, submission):
+    submission()
+    load(database, diff=True)
+    stats = load(database, diff=True)
+    assert stats and all(stat == {'inserted': 0, 'updated': 0, 'deleted': 0} for stat in stats.values())
+    assert counts(database) == expected_counts(2, 4)
+
+
+def test_diff_changed_property(database, submission, records):
+    submission()
+    load(database, diff=True)
+    created = props(database, 'node_case', 'case-0')['created_datetime']
+    submission_records = records()
+    submission_records['case'][0]['disease_type'] = 'Glioma'
+    submission(submission_records)
+    stats = load(database, diff=True)
+    assert stats['node_case'] == {'inserted': 0, 'updated': 1, 'deleted': 0}
+    assert stats['node_sample'] == {'inserted': 0, 'updated': 0, 'deleted': 0}
+    case = props(database, 'node_case', 'case-0')
+    assert case['disease_type'] == 'Glioma'
+    assert case['created_datetime'] == created
+
+
+def test_diff_deleted_leaf(database, submission, records):
+    submission()
+    load(database, diff=True)
+    submission_records = records()
+    del submission_records['sample'][-1]
+    submission(submission_records)
+    stats = load(database, diff=True)
+    assert stats['node_sample'] == {'inserted': 0, 'updated': 0, 'deleted': 1}
+    # its edge goes with it, on delete cascade
+    assert counts(database) == expected_counts(2, 3)
+
+
+def test_rollback_on_foreign_key_violation(database, submission, records):
+    import psycopg2
+    submission()
+    load(database)
+    before = counts(database)
+    submission_records = records()
+    submission_records['sample'][0]['cases'] = {'submitter_id': 'case-9'}
+    submission(submission_records)
+    with pytest.raises(psycopg2.IntegrityError):
+        load(database, delete_first=True)
+    # the project's deletes are rolled back with the failed COPY
+    assert counts(database) == before
+
+
+def test_sorted_edges_copied_in_batches(database, submission, records, monkeypatch):
+    copies = {}
+    copy_from = Loader.copy_from
+
+    def counted(self, table, columns, fp):
+        copies[table] = copies.get(table, 0) + 1
+        return copy_from(self, table, columns, fp)
+
+    monkeypatch.setattr(Loader, 'copy_from', counted)
+    submission(records(cases=3, samples_per_case=4))
+    load(database, batch_size=2, sort_edges=True)
+    assert counts(database) == expected_counts(3, 12)
+    # the 12 sorted sample edges are written after their node table closed, 2 rows per COPY
+    assert copies[edge_tables()['sample']] == 6
+
+
+class RecordingLoader:
+    """Stands in for Loader, records the rows of every COPY."""
+
+    def __init__(self):
+        self.copies = []
+
+    def copy_from(self, table, columns, fp):
+        self.copies.append((table, fp.read().count(b'\n')))
+
+
+def test_followers_flush_with_their_node_table_then_in_batches():
+    loader = RecordingLoader()
+    node = CopyWriter(loader, 'node_case', 'columns', batch_size=2)
+    edge = CopyWriter(loader, 'edge_case', 'columns')
+    node.followers.append(edge)
+    for row in range(3):
+        edge.write(f'edge {row}\n')
+    assert loader.copies == []
+    node.write('node 0\n')
+    node.write('node 1\n')
+    assert loader.copies == [('node_case', 2), ('edge_case', 3)]
+    node.close()
+    # every node row is copied, edges flush full batches on their own
+    for row in range(5):
+        edge.write(f'edge {row}\n')
+    edge.close()
+    assert loader.copies == [('node_case', 2), ('edge_case', 3), ('edge_case', 2), ('edge_case', 2), ('edge_case', 1)]
+
+
+@pytest.mark.parametrize('diff', [False, True])
+def test_shared_program_row_is_upserted(database, submission, records, diff):
+    submission()
+    load(database, diff=diff, delete_first=not diff)
+    created = query(database, "select _props->>'created_datetime' from node_program")[0][0]
+    submission_records = records()
+    submission_records['program'][0]['dbgap_accession_number'] = 'phs000001'
+    submission(submission_records)
+    load(database, diff=diff, delete_first=not diff)
+    assert query(database, "select _props->>'dbgap_accession_number', _props->>'created_datetime'"
+                           " from node_program") == [('phs000001', created)]
@@ -0,0 +1,53 @@
+"""Record validation against compiled node schemas."""
+import pytest
+
+from importer import validator
+from importer.validator import Validators
+
+DOCUMENTS = {
+    'case.yaml': {
+        'id': 'case', 'type': 'object', 'additionalProperties': False,
+        'systemProperties': ['id', 'project_id', 'state'],
+        'required': ['submitter_id', 'type', 'state'],
+        'properties': {
+            'type': {'type': 'string'},
+            'id': {'type': 'string'},
+            'project_id': {'type': 'string'},
+            'submitter_id': {'type': 'string'},
+            'state': {'default': 'validated', 'oneOf': [{'enum': ['uploading', 'live']}, {'enum': ['validated']}]},
+            'disease_type': {'type': 'string'},
+        },
+    },
+}
+
+
+@pytest.fixture(params=['fastjsonschema', 'jsonschema'])
+def validators(request, monkeypatch):
+    pytest.importorskip(request.param)
+    monkeypatch.setattr(validator, 'VALIDATOR', request.param)
+    return Validators(DOCUMENTS)
+
+
+def test_system_properties_with_a_default_are_set_by_the_service(validators):
+    assert validators.errors({'type': 'case', 'submitter_id': 'case-0'}) == []
+    assert validators.errors({'type': 'case', 'submitter_id': 'case-0', 'state': 'anything'}) == []
+
+
+def test_other_properties_are_validated(validators):
+    assert validators.errors({'type': 'case', 'submitter_id': 'case-0', 'project_id': 1})
+    assert validators.errors({'type': 'case', 'submitter_id': 'case-0', 'disease_type': 1})
+    assert validators.errors({'type': 'case', 'submitter_id': 'case-0', 'unknown': 'x'})
+    assert validators.errors({'type': 'case'})
+    assert validators.errors({'type': 'sample'}) == [('', 'unknown type sample')]
+
+
+def test_entity_is_not_modified(validators):
+    entity = {'type': 'case', 'submitter_id': 'case-0'}
+    validators.errors(entity)
+    assert entity == {'type': 'case', 'submitter_id': 'case-0'}
+
+
+def test_documents_are_not_modified(validators):
+    validators.errors({'type': 'case', 'submitter_id': 'case-0'})
+    assert DOCUMENTS['case.yaml']['required'] == ['submitter_id', 'type', 'state']
+    assert 'oneOf' in DOCUMENTS['case.yaml']['properties']['state']